@@ -10,7 +10,7 @@ import chapters
 
 MediaStreamInfo = namedtuple('MediaStreamInfo', ['id', 'info', 'default', 'title'])
 SubtitlesStreamInfo = namedtuple('SubtitlesStreamInfo', ['id', 'info', 'type', 'default', 'title'])
-MediaInfo = namedtuple('MediaInfo', ['video', 'audio', 'subtitles', 'chapters'])
+MediaInfo = namedtuple('MediaInfo', ['video', 'audio', 'subtitles', 'chapters', 'duration'])
 
 
 class FFmpeg(object):
@@ -57,6 +57,25 @@ class FFmpeg(object):
                 raise SushiError("Couldn't invoke ffmpeg, check that it's installed")
             raise
 
+    @staticmethod
+    def open_audio_pipe(input_path, audio_stream, audio_rate, start=None, duration=None):
+        args = ['ffmpeg', '-hide_banner']
+        if start is not None:
+            # input seeking, ffmpeg jumps close to start and only decodes from there
+            args.extend(('-ss', '{0:.3f}'.format(start)))
+        if duration is not None:
+            args.extend(('-t', '{0:.3f}'.format(duration)))
+        args.extend(('-i', input_path, '-map', '0:{0}'.format(audio_stream),
+                     '-ar', str(audio_rate), '-ac', '1', '-acodec', 'pcm_s16le', '-f', 's16le', '-'))
+
+        logging.info('ffmpeg args: {0}'.format(' '.join(('"{0}"' if ' ' in a else '{0}').format(a) for a in args)))
+        try:
+            return subprocess.Popen(args, stdout=subprocess.PIPE)
+        except OSError as e:
+            if e.errno == 2:
+                raise SushiError("Couldn't invoke ffmpeg, check that it's installed")
+            raise
+
     @staticmethod
     def _get_audio_streams(info):
         streams = re.findall(r'Stream\s\#0:(\d+).*?Audio:\s*(.*?(?:\((default)\))?)\s*?(?:\(forced\))?\r?\n'
@@ -73,6 +92,13 @@ class FFmpeg(object):
                              info, flags=re.VERBOSE)
         return [MediaStreamInfo(int(x[0]), x[1], x[2] != '', x[3]) for x in streams]
 
+    @staticmethod
+    def _get_duration(info):
+        match = re.search(r'Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)', info)
+        if not match:
+            return None
+        return int(match.group(1)) * 3600 + int(match.group(2)) * 60 + float(match.group(3))
+
     @staticmethod
     def _get_chapters_times(info):
         return map(float, re.findall(r'Chapter #0.\d+: start (\d+\.\d+)', info))
@@ -98,7 +124,8 @@ class FFmpeg(object):
         audio_streams = cls._get_audio_streams(info)
         subs_streams = cls._get_subtitles_streams(info)
         chapter_times = cls._get_chapters_times(info)
-        return MediaInfo(video_streams, audio_streams, subs_streams, chapter_times)
+        duration = cls._get_duration(info)
+        return MediaInfo(video_streams, audio_streams, subs_streams, chapter_times, duration)
 
 
 class MkvToolnix(object):
@@ -231,6 +258,7 @@ class Demuxer(object):
         self._is_wav = get_extension(self._path) == '.wav'
         self._mi = None if self._is_wav else FFmpeg.get_media_info(self._path)
         self._demux_audio = self._demux_subs = self._make_timecodes = self._make_keyframes = self._write_chapters = False
+        self._pipe_audio = False
 
     @property
     def is_wav(self):
@@ -246,6 +274,15 @@ class Demuxer(object):
             return []
         return self._mi.chapters
 
+    @property
+    def duration(self):
+        """
+        Duration of the container in seconds as reported by ffmpeg, None if it's unknown
+        """
+        if self.is_wav:
+            return None
+        return self._mi.duration
+
     @property
     def has_video(self):
         return not self.is_wav and self._mi.video
@@ -256,6 +293,16 @@ class Demuxer(object):
         self._audio_sample_rate = sample_rate
         self._demux_audio = True
 
+    def set_audio_pipe(self, stream_idx, sample_rate):
+        self._audio_stream = self._select_stream(self._mi.audio, stream_idx, 'audio')
+        self._audio_sample_rate = sample_rate
+        self._pipe_audio = True
+
+    def open_audio_pipe(self, start=None, duration=None):
+        if not self._pipe_audio:
+            raise SushiError('Audio pipe of {0} was not configured'.format(self._path))
+        return FFmpeg.open_audio_pipe(self._path, self._audio_stream.id, self._audio_sample_rate, start, duration)
+
     def set_script(self, stream_idx, output_path):
         self._script_stream = self._select_stream(self._mi.subtitles, stream_idx, 'subtitles')
         self._script_output_path = output_path
@@ -273,6 +320,9 @@ class Demuxer(object):
         self._keyframes_output_path = output_path
         self._make_keyframes = True
 
+    def get_audio_stream_id(self, stream_idx):
+        return self._select_stream(self._mi.audio, stream_idx, 'audio').id
+
     def get_subs_type(self, stream_idx):
         return self._select_stream(self._mi.subtitles, stream_idx, 'subtitles').type
 
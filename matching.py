@@ -0,0 +1,280 @@
+"""
+Template matching backends for WavStream.find_substream.
+Every backend returns the same scores as cv2.matchTemplate with TM_SQDIFF_NORMED (including its clamping),
+so they can be switched freely.
+"""
+import collections
+import hashlib
+import math
+import threading
+
+import cv2
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from common import SushiError, clip
+
+# opencv is faster until pattern size * window size gets around this value
+FFT_MIN_WORK = 2e10
+FFT_MIN_BLOCK = 4096
+
+
+def match_cv2(source, pattern):
+    return cv2.matchTemplate(source, pattern, cv2.TM_SQDIFF_NORMED)
+
+
+def match_fft(source, pattern):
+    cross = correlate_fft(source, pattern)
+    pattern_size = pattern.shape[1]
+    squares = get_square_sums(source[0])
+    return normalize_sqdiff(cross, squares[pattern_size:] - squares[:-pattern_size], get_energy(pattern))
+
+
+def correlate_cv2(source, pattern):
+    return cv2.matchTemplate(source, pattern, cv2.TM_CCORR)[0].astype(np.float64)
+
+
+def correlate_fft(source, pattern):
+    """
+    Cross-correlation computed by overlap-save FFT convolution, all blocks are transformed by a single row-wise DFT.
+    The data is centered on the pattern mean before the transform, so float32 precision is enough even for
+    long uint8 patterns.
+    """
+    source = source[0]
+    pattern = pattern[0].astype(np.float64)
+    pattern_size = len(pattern)
+    count = len(source) - pattern_size + 1
+    if count < 1:
+        raise SushiError('Search window is shorter than the pattern')
+
+    mean = pattern.mean()
+    block_size = cv2.getOptimalDFTSize(min(max(2 * pattern_size, FFT_MIN_BLOCK), count + pattern_size - 1))
+    step = block_size - pattern_size + 1
+    blocks_count = -(-count // step)
+
+    padded = np.zeros((blocks_count - 1) * step + block_size, np.float32)
+    np.subtract(source, mean, out=padded[:len(source)], casting='unsafe')
+    blocks = np.ascontiguousarray(as_strided(padded, shape=(blocks_count, block_size),
+                                             strides=(step * padded.itemsize, padded.itemsize)))
+    pattern_block = np.zeros((1, block_size), np.float32)
+    pattern_block[0, :pattern_size] = pattern - mean
+
+    pattern_spectrum = np.repeat(cv2.dft(pattern_block, flags=cv2.DFT_ROWS), blocks_count, axis=0)
+    spectrum = cv2.mulSpectrums(cv2.dft(blocks, flags=cv2.DFT_ROWS), pattern_spectrum, cv2.DFT_ROWS, conjB=True)
+    centered = cv2.idft(spectrum, flags=cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT | cv2.DFT_ROWS)[:, :step].ravel()[:count]
+
+    # sum(s * p) = sum((s - mean) * (p - mean)) + mean * (sum(s) + sum(p)) - size * mean^2
+    sums = get_sums(source)
+    cross = centered.astype(np.float64)
+    cross += mean * (sums[pattern_size:] - sums[:-pattern_size] + pattern.sum() - pattern_size * mean)
+    return cross
+
+
+def get_sums(data):
+    """
+    Prefix sums in double precision, sum of data[a:b] is result[b] - result[a]
+    """
+    return np.concatenate(([0.0], np.cumsum(data, dtype=np.float64)))
+
+
+def get_square_sums(data):
+    data = data.astype(np.float64)
+    data *= data
+    return get_sums(data)
+
+
+def get_energy(pattern):
+    pattern = pattern[0].astype(np.float64)
+    return np.dot(pattern, pattern)
+
+
+def normalize_sqdiff(cross, window_squares, pattern_squares):
+    """
+    Turns cross-correlation into TM_SQDIFF_NORMED scores, window_squares being sums of squares of every window
+    """
+    diff = window_squares - 2 * cross
+    diff += pattern_squares
+    np.maximum(diff, 0, out=diff)
+    norm = np.sqrt(np.maximum(window_squares, 0)) * math.sqrt(pattern_squares)
+
+    # opencv clamps everything that isn't clearly below the norm to 1
+    result = np.ones(len(diff), np.float32)
+    below = diff < norm
+    result[below] = diff[below] / norm[below]
+    return result.reshape((1, -1))
+
+
+def decimate(samples, factor):
+    """
+    Averages every factor samples into one, the incomplete tail is dropped
+    """
+    size = len(samples[0]) // factor * factor
+    return samples[:, :size].reshape((-1, factor)).mean(axis=1, dtype=np.float32).reshape((1, -1))
+
+
+def select_candidates(scores, positions, count, distance):
+    """
+    Positions of up to count best scores, each one further than distance from all better ones
+    """
+    selected = []
+    for idx in np.argsort(scores, kind='mergesort'):
+        position = positions[idx]
+        if all(abs(position - other) > distance for other in selected):
+            selected.append(position)
+            if len(selected) == count:
+                break
+    return selected
+
+
+def select_minima(scores, count, distance):
+    """
+    Indices of up to count best scores, each further than distance from all better ones.
+    Only the best score of every distance long block is considered, which keeps it linear.
+    """
+    block_size = max(int(distance), 1)
+    padded = np.empty(-(-len(scores) // block_size) * block_size, np.float64)
+    padded[:len(scores)] = scores
+    padded[len(scores):] = np.inf
+    minima = padded.reshape((-1, block_size)).argmin(axis=1) + np.arange(0, len(padded), block_size)
+    return select_candidates(scores[minima], minima, count, distance)
+
+
+def interpolate_minimum(scores, idx):
+    """
+    Fractional position of the minimum at idx, from the vertex of the parabola through it and its neighbours.
+    Minima at the edges or next to clamped scores are returned as they are.
+    """
+    if idx < 1 or idx >= len(scores) - 1:
+        return float(idx)
+    before, at, after = float(scores[idx - 1]), float(scores[idx]), float(scores[idx + 1])
+    curvature = before - 2 * at + after
+    if curvature <= 0 or max(before, after) >= 1:
+        return float(idx)
+    return idx + clip(0.5 * (before - after) / curvature, -0.5, 0.5)
+
+
+def merge_ranges(ranges):
+    """
+    Merges overlapping inclusive (first, last) ranges
+    """
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        elif first <= last:
+            merged.append((first, last))
+    return merged
+
+
+BACKENDS = {
+    'cv2': match_cv2,
+    'fft': match_fft,
+}
+
+CORRELATION_BACKENDS = {
+    'cv2': correlate_cv2,
+    'fft': correlate_fft,
+}
+
+
+def select_backend(pattern_size, window_size):
+    """
+    Picks the backend that is expected to be faster for these sizes
+    """
+    return 'fft' if float(pattern_size) * window_size >= FFT_MIN_WORK else 'cv2'
+
+
+def match_template(source, pattern, backend='auto'):
+    if backend == 'auto':
+        backend = select_backend(pattern.shape[1], source.shape[1] - pattern.shape[1] + 1)
+    if backend not in BACKENDS:
+        raise SushiError('Unknown matching backend: {0}'.format(backend))
+    return BACKENDS[backend](source, pattern)
+
+
+def correlate(source, pattern, backend='auto'):
+    """
+    Raw cross-correlation of the pattern with every window of the source, as float64
+    """
+    if backend == 'auto':
+        backend = select_backend(pattern.shape[1], source.shape[1] - pattern.shape[1] + 1)
+    if backend not in CORRELATION_BACKENDS:
+        raise SushiError('Unknown matching backend: {0}'.format(backend))
+    return CORRELATION_BACKENDS[backend](source, pattern)
+
+
+class ScoreCache(object):
+    """
+    Score curves of patterns over the positions already searched, so searching for the same pattern again
+    only computes scores of positions that weren't searched before. Curves of the least recently used patterns
+    are dropped when all of them take more than max_bytes.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        # key -> sorted list of (first position, scores) not touching each other
+        self._curves = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(pattern):
+        return hashlib.sha1(np.ascontiguousarray(pattern).view(np.uint8)).hexdigest(), pattern.dtype.str
+
+    def get(self, key, first, last, compute):
+        """
+        Scores of positions from first to last inclusive, compute(first, last) is called for the missing ones
+        """
+        with self._lock:
+            segments = self._curves.get(key, [])
+
+        parts = []
+        computed = False
+        position = first
+        for segment_first, scores in segments:
+            segment_last = segment_first + len(scores) - 1
+            if segment_last < position or segment_first > last:
+                continue
+            if segment_first > position:
+                parts.append(compute(position, segment_first - 1))
+                computed = True
+                position = segment_first
+            parts.append(scores[position - segment_first:min(segment_last, last) - segment_first + 1])
+            position = min(segment_last, last) + 1
+        if position <= last:
+            parts.append(compute(position, last))
+            computed = True
+        result = np.concatenate(parts) if len(parts) != 1 else parts[0]
+
+        if computed:
+            self._store(key, first, result)
+        else:
+            with self._lock:
+                if key in self._curves:
+                    self._curves[key] = self._curves.pop(key)
+        return result
+
+    def _store(self, key, first, scores):
+        with self._lock:
+            last = first + len(scores) - 1
+            kept = []
+            for segment_first, segment_scores in self._curves.pop(key, []):
+                segment_last = segment_first + len(segment_scores) - 1
+                self._size -= segment_scores.nbytes
+                if segment_last < first - 1 or segment_first > last + 1:
+                    kept.append((segment_first, segment_scores))
+                    self._size += segment_scores.nbytes
+                    continue
+                # merging touching segments into the new one
+                if segment_first < first:
+                    scores = np.concatenate((segment_scores[:first - segment_first], scores))
+                    first = segment_first
+                if segment_last > last:
+                    scores = np.concatenate((scores, segment_scores[last - segment_first + 1:]))
+                    last = segment_last
+            kept.append((first, scores))
+            self._size += scores.nbytes
+            self._curves[key] = sorted(kept, key=lambda segment: segment[0])
+
+            while self._size > self.max_bytes and len(self._curves) > 1:
+                _, segments = self._curves.popitem(last=False)
+                self._size -= sum(segment_scores.nbytes for _, segment_scores in segments)
@@ -9,6 +9,7 @@ import re
 import subprocess
 import argparse
 
+import numpy as np
 from common import format_time
 from demux import Timecodes
 from subs import AssScript
@@ -158,6 +159,40 @@ def run_wav_test(test_name, file_path, params):
     return True
 
 
+def run_encoding_benchmark(test_name, src_path, dst_path, params):
+    """
+    Reports memory used by every sample type and how many matches agree with the float32 ones.
+    Fails if that's less than min_agreement percent of matches for some sample type.
+    """
+    sample_rate = params.get('sample_rate', 12000)
+    pattern_seconds = params.get('pattern_seconds', 1.0)
+    results = {}
+    for sample_type in WavStream.SAMPLE_TYPES:
+        src_stream = WavStream(src_path, sample_rate, sample_type)
+        dst_stream = WavStream(dst_path, sample_rate, sample_type)
+        matches = []
+        for start in np.arange(0, src_stream.duration_seconds - pattern_seconds, params.get('step', 30.0)):
+            pattern = src_stream.get_substream(start, start + pattern_seconds)
+            _, match_time = dst_stream.find_substream(pattern, start + params.get('shift', 0), params.get('window', 10))
+            matches.append(match_time)
+        results[sample_type] = (src_stream.data.nbytes + dst_stream.data.nbytes, np.array(matches))
+
+    reference = results['float32'][1]
+    min_agreement = params.get('min_agreement', 90.0)
+    passed = True
+    logging.info('Encodings of "{0}" ({1} patterns):'.format(test_name, len(reference)))
+    for sample_type in WavStream.SAMPLE_TYPES:
+        nbytes, matches = results[sample_type]
+        agreement = np.mean(np.abs(matches - reference) < 0.01) * 100 if len(reference) else 100.0
+        logging.info('  {0}: {1:.1f} MB, {2:.1f}% of matches within 10ms of float32'
+                     .format(sample_type, nbytes / 1024.0 / 1024.0, agreement))
+        if agreement < min_agreement:
+            logging.critical('Sample type {0} of "{1}" agrees with float32 on too few matches: {2:.1f}% vs {3}%'
+                             .format(sample_type, test_name, agreement, min_agreement))
+            passed = False
+    return passed
+
+
 def create_arg_parser():
     parser = argparse.ArgumentParser(description='Sushi regression testing util')
 
@@ -207,6 +242,14 @@ def run():
                 failed += 1
             logging.info('')
 
+    if should_run("encodings"):
+        for test_name, params in config.get('encodings', {}).iteritems():
+            ran += 1
+            if not run_encoding_benchmark(test_name, os.path.join(config['basepath'], params['src']),
+                                          os.path.join(config['basepath'], params['dst']), params):
+                failed += 1
+            logging.info('')
+
     logging.info('Ran {0} tests, {1} failed'.format(ran, failed))
 
 
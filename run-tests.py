@@ -3,5 +3,7 @@ from tests.timecodes import *
 from tests.main import *
 from tests.subtitles import *
 from tests.demuxing import *
+from tests.audio import *
+from tests.template_matching import *
 
 unittest.main(verbosity=0)
@@ -6,17 +6,23 @@ import argparse
 import os
 import bisect
 import collections
-from itertools import takewhile, izip, chain
+from itertools import takewhile, izip, groupby
 import time
+import random
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
+import cv2
 import numpy as np
 
 import chapters
 from common import SushiError, get_extension, format_time, ensure_static_collection
 from demux import Timecodes, Demuxer
 import keyframes
+from matching import BACKENDS
 from subs import AssScript, SrtScript
-from wav import WavStream
+from wav import WavStream, LazyWavStream, OutOfCoreWavStream, SparseWavStream, SharedWavStream, WavStreamCache, \
+    RawPcmPipe
 
 
 try:
@@ -38,6 +44,26 @@ else:
 
 ALLOWED_ERROR = 0.01
 MAX_GROUP_STD = 0.025
+SOURCE_SPAN_MARGIN = 1.0
+SOURCE_SPAN_MERGE_GAP = 5.0
+# number of first groups of a chapter tried to find the shift it starts with
+CHAPTER_PROBES = 3
+# loudness envelope samples per second and seconds of it matched at once when building the offset map
+OFFSET_MAP_RATE = 100
+OFFSET_MAP_BLOCK = 20
+# minimal correlation of a block to be trusted
+OFFSET_MAP_MIN_SCORE = 0.7
+# offsets closer than this are considered the same
+OFFSET_MAP_TOLERANCE = 0.1
+# number of best matches of a group considered when recovering from errors
+RECOVERY_CANDIDATES = 5
+# number of groups and window used to verify a constant shift
+CONSTANT_SHIFT_SAMPLES = 10
+CONSTANT_SHIFT_WINDOW = 1.0
+# groups with source audio quieter than this fraction of the full range don't give reliable matches
+SILENT_GROUP_LOUDNESS = 0.01
+# working rate of --sample-rate auto, match times are interpolated between samples to keep their precision
+AUTO_SAMPLE_RATE = 4000
 VERSION = '0.5.1'
 
 
@@ -397,7 +423,109 @@ def prepare_search_groups(events, source_duration, chapter_times, max_ts_duratio
     return passed_groups
 
 
-def calculate_shifts(src_stream, dst_stream, groups_list, normal_window, max_window, rewind_thresh):
+def link_silent_groups(src_stream, search_groups, min_loudness=SILENT_GROUP_LOUDNESS):
+    """
+    Links events of groups whose source audio is too quiet or flat to be matched reliably to the closest event
+    of the closest other group, so they take its shift instead of being searched. Returns the groups left to search.
+    """
+    loud = [src_stream.get_loudness(g[0].start, g[-1].end) >= min_loudness for g in search_groups]
+    passed_groups = [g for g, is_loud in zip(search_groups, loud) if is_loud]
+    if not passed_groups:
+        return search_groups
+
+    for group, is_loud in zip(search_groups, loud):
+        if is_loud:
+            continue
+        logging.info('{0}: skipped because the audio is silent'.format(format_time(group[0].start)))
+        previous = next((g for g in reversed(passed_groups) if g[0].start <= group[0].start), None)
+        following = next((g for g in passed_groups if g[0].start > group[0].start), None)
+        if following is None or (previous is not None and
+                                 group[0].start - previous[-1].end < following[0].start - group[-1].end):
+            link_to = previous[-1]
+        else:
+            link_to = following[0]
+        for event in group:
+            event.link_event(link_to)
+    return passed_groups
+
+
+def get_source_spans(search_groups, source_duration):
+    """
+    Merged time ranges of the source audio read by search groups, with some margin for inaccurate seeking.
+    Close ranges are merged because starting a new decoder costs more than decoding a few seconds.
+    """
+    spans = []
+    for start, end in sorted((g[0].start - SOURCE_SPAN_MARGIN, g[-1].end + SOURCE_SPAN_MARGIN) for g in search_groups):
+        start, end = max(start, 0), min(end, source_duration)
+        if spans and start - spans[-1][1] <= SOURCE_SPAN_MERGE_GAP:
+            spans[-1][1] = max(spans[-1][1], end)
+        else:
+            spans.append([start, end])
+    return [(start, end) for start, end in spans if end > start]
+
+
+class SpeculativeSearches(object):
+    """
+    Small window searches of the following spans started in advance on a thread pool, assuming the shift they are
+    searched around won't change. A result is only used if the span is later searched over exactly the same samples
+    of the destination, so it never differs from searching in place.
+    """
+    def __init__(self, src_stream, dst_stream, spans, window, lookahead):
+        self._src_stream = src_stream
+        self._dst_stream = dst_stream
+        self._spans = spans
+        self._window = window
+        self._lookahead = lookahead
+        self._pool = ThreadPool(lookahead) if lookahead else None
+        # span index -> (search range, async result)
+        self._results = {}
+
+    def _search(self, idx, shift):
+        start, end = self._spans[idx]
+        return self._dst_stream.find_substream(self._src_stream.get_substream(start, end), start + shift, self._window)
+
+    def _get_search_range(self, idx, shift):
+        # shifts accumulate float noise, so searches are compared by the destination samples they cover
+        return self._dst_stream._get_search_range(0, self._spans[idx][0] + shift, self._window)
+
+    def dispatch(self, idx, shift):
+        """
+        Starts searching the spans following idx around shift, unless they are already searched around it
+        """
+        if not self._pool:
+            return
+        for next_idx in xrange(idx + 1, min(idx + 1 + self._lookahead, len(self._spans))):
+            search_range = self._get_search_range(next_idx, shift)
+            if next_idx not in self._results or self._results[next_idx][0][1:] != search_range[1:]:
+                self._results[next_idx] = search_range, self._pool.apply_async(self._search, (next_idx, shift))
+
+    def get(self, idx, shift):
+        speculated = self._results.pop(idx, None)
+        if speculated:
+            search_range = self._get_search_range(idx, shift)
+            if speculated[0][1:] == search_range[1:]:
+                diff, time = speculated[1].get()
+                # times are relative to the start of the search range, which can differ by less than a sample
+                return diff, time + (search_range[0] - speculated[0][0])
+        return self._search(idx, shift)
+
+    def close(self):
+        if self._pool:
+            # searches that are still queued are not needed anymore
+            self._pool.terminate()
+            self._pool.join()
+
+
+def find_shifts(src_stream, dst_stream, spans, normal_window, max_window, rewind_thresh, initial_shift=0,
+                lookahead=0, offset_map=None, recovery_candidates=False):
+    """
+    Searches for (start, end) spans of the source in the destination one by one.
+    Returns a state with the found shift (None when not found) and diff for every span.
+    Small window searches of lookahead following spans are done in advance on a thread pool.
+    offset_map (see build_offset_map) is used to center searches where the shift jumps.
+    With recovery_candidates, uncommitted groups are checked against the other good matches of the search
+    that just failed before searching around them again.
+    """
     def log_shift(state):
         logging.info('{0}-{1}: shift: {2:0.10f}, diff: {3:0.10f}'
                       .format(format_time(state["start_time"]), format_time(state["end_time"]), state["shift"], state["diff"]))
@@ -412,90 +540,117 @@ def calculate_shifts(src_stream, dst_stream, groups_list, normal_window, max_win
     committed_states = []
     uncommitted_states = []
     window = normal_window
-    while idx < len(groups_list):
-        search_group = groups_list[idx]
-        tv_audio = src_stream.get_substream(search_group[0].start, search_group[-1].end)
-        original_time = search_group[0].start
-        group_state = {"start_time": search_group[0].start, "end_time": search_group[-1].end, "shift": None, "diff": None}
-        last_committed_shift = committed_states[-1]["shift"] if committed_states else 0
-        diff = new_time = None
-
-        if not uncommitted_states:
-            if original_time + last_committed_shift > dst_stream.duration_seconds:
-                # event outside of audio range, all events past it are also guaranteed to fail
-                for g in groups_list[idx:]:
-                    committed_states.append({"start_time": g[0].start, "end_time": g[-1].end, "shift": None, "diff": None})
-                    logging.info("{0}-{1}: outside of audio range".format(format_time(g[0].start), format_time(g[-1].end)))
-                break
-
-            if small_window < window:
-                diff, new_time = dst_stream.find_substream(tv_audio, original_time + last_committed_shift, small_window)
-
-            if new_time is not None and abs_diff(new_time - original_time, last_committed_shift) <= ALLOWED_ERROR:
-                # fastest case - small window worked, commit the group immediately
-                group_state.update({"shift": new_time - original_time, "diff": diff})
-                committed_states.append(group_state)
-                log_shift(group_state)
-                if window != normal_window:
-                    logging.info("Going back to window {0} from {1}".format(normal_window, window))
-                    window = normal_window
+    searches = SpeculativeSearches(src_stream, dst_stream, spans, small_window, lookahead)
+    try:
+        while idx < len(spans):
+            start_time, end_time = spans[idx]
+            tv_audio = src_stream.get_substream(start_time, end_time)
+            original_time = start_time
+            group_state = {"start_time": start_time, "end_time": end_time, "shift": None, "diff": None}
+            last_committed_shift = committed_states[-1]["shift"] if committed_states else initial_shift
+            diff = new_time = None
+
+            if idx + 1 < len(spans):
+                next_start, next_end = spans[idx + 1]
+                src_stream.prefetch(next_start, next_end)
+                dst_stream.prefetch(next_start + last_committed_shift - window, next_end + last_committed_shift + window)
+
+            if not uncommitted_states:
+                if original_time + last_committed_shift > dst_stream.duration_seconds:
+                    # event outside of audio range, all events past it are also guaranteed to fail
+                    for start, end in spans[idx:]:
+                        committed_states.append({"start_time": start, "end_time": end, "shift": None, "diff": None})
+                        logging.info("{0}-{1}: outside of audio range".format(format_time(start), format_time(end)))
+                    break
+
+                if small_window < window:
+                    searches.dispatch(idx, last_committed_shift)
+                    diff, new_time = searches.get(idx, last_committed_shift)
+
+                if new_time is not None and abs_diff(new_time - original_time, last_committed_shift) <= ALLOWED_ERROR:
+                    # fastest case - small window worked, commit the group immediately
+                    group_state.update({"shift": new_time - original_time, "diff": diff})
+                    committed_states.append(group_state)
+                    log_shift(group_state)
+                    if window != normal_window:
+                        logging.info("Going back to window {0} from {1}".format(normal_window, window))
+                        window = normal_window
+                    idx += 1
+                    continue
+
+            terminate = False
+            # searching from last committed shift, first from the one in the offset map if it expects a jump here
+            search_offsets = [last_committed_shift]
+            mapped_shift = offset_map.get_shift(original_time) if offset_map else None
+            if mapped_shift is not None and abs_diff(mapped_shift, last_committed_shift) > OFFSET_MAP_TOLERANCE:
+                search_offsets.insert(0, mapped_shift)
+            candidates = []
+            for start_offset in search_offsets:
+                if terminate or original_time + start_offset >= dst_stream.duration_seconds:
+                    continue
+                if recovery_candidates:
+                    candidates = dst_stream.find_substream_split_candidates(tv_audio, original_time + start_offset,
+                                                                            window, RECOVERY_CANDIDATES)
+                else:
+                    candidates = [dst_stream.find_substream_split(tv_audio, original_time + start_offset, window)]
+                (diff, new_time), left_side_time, right_side_time = candidates[0]
+                terminate = abs_diff(left_side_time, right_side_time) <= ALLOWED_ERROR and abs_diff(new_time, left_side_time) <= ALLOWED_ERROR
+                log_uncommitted(group_state, new_time - original_time, left_side_time - original_time,
+                                right_side_time - original_time, start_offset)
+
+            if not terminate and uncommitted_states and uncommitted_states[-1]["shift"] is not None \
+                    and original_time + uncommitted_states[-1]["shift"] < dst_stream.duration_seconds:
+                start_offset =  uncommitted_states[-1]["shift"]
+                # the match uncommitted groups lead to is often among the other candidates found above
+                candidate = next((c for c in candidates[1:]
+                                  if abs_diff(c[0][1] - original_time, start_offset) <= ALLOWED_ERROR
+                                  and abs_diff(c[1], c[2]) <= ALLOWED_ERROR and abs_diff(c[0][1], c[1]) <= ALLOWED_ERROR),
+                                 None)
+                (diff, new_time), left_side_time, right_side_time = candidate or dst_stream.find_substream_split(
+                    tv_audio, original_time + start_offset, window)
+                terminate = abs_diff(left_side_time, right_side_time) <= ALLOWED_ERROR and abs_diff(new_time, left_side_time) <= ALLOWED_ERROR
+                log_uncommitted(group_state, new_time - original_time, left_side_time - original_time,
+                                right_side_time - original_time, start_offset)
+
+            shift = new_time - original_time
+            if not terminate:
+                # we aren't back on track yet - add this group to uncommitted
+                group_state.update({"shift": shift, "diff": diff})
+                uncommitted_states.append(group_state)
                 idx += 1
+                if rewind_thresh == len(uncommitted_states) and window < max_window:
+                    logging.warn("Detected possibly broken segment starting at {0}, increasing the window from {1} to {2}"
+                                 .format(format_time(uncommitted_states[0]["start_time"]), window, max_window))
+                    window = max_window
+                    idx = len(committed_states)
+                    del uncommitted_states[:]
                 continue
 
-        left_audio_half, right_audio_half = np.split(tv_audio, [len(tv_audio[0])/2], axis=1)
-        right_half_offset = len(left_audio_half[0]) / float(src_stream.sample_rate)
-        terminate = False
-        # searching from last committed shift
-        if original_time + last_committed_shift < dst_stream.duration_seconds:
-            diff, new_time = dst_stream.find_substream(tv_audio, original_time + last_committed_shift, window)
-            left_side_time = dst_stream.find_substream(left_audio_half, original_time + last_committed_shift, window)[1]
-            right_side_time = dst_stream.find_substream(right_audio_half, original_time + last_committed_shift + right_half_offset, window)[1] - right_half_offset
-            terminate = abs_diff(left_side_time, right_side_time) <= ALLOWED_ERROR and abs_diff(new_time, left_side_time) <= ALLOWED_ERROR
-            log_uncommitted(group_state, new_time - original_time, left_side_time - original_time,
-                            right_side_time - original_time, last_committed_shift)
-
-        if not terminate and uncommitted_states and uncommitted_states[-1]["shift"] is not None \
-                and original_time + uncommitted_states[-1]["shift"] < dst_stream.duration_seconds:
-            start_offset =  uncommitted_states[-1]["shift"]
-            diff, new_time = dst_stream.find_substream(tv_audio, original_time + start_offset, window)
-            left_side_time = dst_stream.find_substream(left_audio_half, original_time + start_offset, window)[1]
-            right_side_time = dst_stream.find_substream(right_audio_half, original_time + start_offset + right_half_offset, window)[1] - right_half_offset
-            terminate = abs_diff(left_side_time, right_side_time) <= ALLOWED_ERROR and abs_diff(new_time, left_side_time) <= ALLOWED_ERROR
-            log_uncommitted(group_state, new_time - original_time, left_side_time - original_time,
-                            right_side_time - original_time, start_offset)
-
-        shift = new_time - original_time
-        if not terminate:
-            # we aren't back on track yet - add this group to uncommitted
-            group_state.update({"shift": shift, "diff": diff})
+            # we're back on track - apply current shift to all broken events
+            if uncommitted_states:
+                logging.warning("Events from {0} to {1} will most likely be broken!".format(
+                    format_time(uncommitted_states[0]["start_time"]),
+                    format_time(uncommitted_states[-1]["end_time"])))
+
             uncommitted_states.append(group_state)
+            for state in uncommitted_states:
+                state.update({"shift": shift, "diff": diff})
+                log_shift(state)
+            committed_states.extend(uncommitted_states)
+            del uncommitted_states[:]
             idx += 1
-            if rewind_thresh == len(uncommitted_states) and window < max_window:
-                logging.warn("Detected possibly broken segment starting at {0}, increasing the window from {1} to {2}"
-                             .format(format_time(uncommitted_states[0]["start_time"]), window, max_window))
-                window = max_window
-                idx = len(committed_states)
-                del uncommitted_states[:]
-            continue
-
-        # we're back on track - apply current shift to all broken events
-        if uncommitted_states:
-            logging.warning("Events from {0} to {1} will most likely be broken!".format(
-                format_time(uncommitted_states[0]["start_time"]),
-                format_time(uncommitted_states[-1]["end_time"])))
 
-        uncommitted_states.append(group_state)
-        for state in uncommitted_states:
-            state.update({"shift": shift, "diff": diff})
-            log_shift(state)
-        committed_states.extend(uncommitted_states)
-        del uncommitted_states[:]
-        idx += 1
+    finally:
+        searches.close()
 
     for state in uncommitted_states:
         log_shift(state)
 
-    for idx, (search_group, group_state) in enumerate(izip(groups_list, chain(committed_states, uncommitted_states))):
+    return committed_states + uncommitted_states
+
+
+def apply_shifts(groups_list, states):
+    for idx, (search_group, group_state) in enumerate(izip(groups_list, states)):
         if group_state["shift"] is None:
             for group in reversed(groups_list[:idx]):
                 link_to = next((x for x in reversed(group) if not x.linked), None)
@@ -508,6 +663,220 @@ def calculate_shifts(src_stream, dst_stream, groups_list, normal_window, max_win
                 e.set_shift(group_state["shift"], group_state["diff"])
 
 
+class OffsetMap(object):
+    """
+    Piecewise constant offsets of the destination audio relative to the source, as sorted (start time, offset) pairs
+    """
+    def __init__(self, segments):
+        self.segments = segments
+        self._starts = [start for start, _ in segments]
+
+    def get_shift(self, time):
+        if not self.segments:
+            return None
+        return self.segments[max(bisect.bisect_right(self._starts, time) - 1, 0)][1]
+
+
+def find_offset_change(src_envelope, dst_envelope, first, last, old_offset, new_offset):
+    """
+    Position between first and last envelope samples after which new_offset fits the envelopes better than old_offset
+    """
+    positions = np.arange(first, last)
+    gain = src_envelope.mean() / max(dst_envelope.mean(), 1e-6)
+
+    def get_errors(offset):
+        dst_positions = np.clip(positions + int(round(offset * OFFSET_MAP_RATE)), 0, len(dst_envelope) - 1)
+        return (src_envelope[positions] - gain * dst_envelope[dst_positions]) ** 2
+
+    # total error when switching to the new offset at every position
+    old_errors = np.concatenate(([0], np.cumsum(get_errors(old_offset))))
+    new_errors = np.concatenate(([0], np.cumsum(get_errors(new_offset)[::-1])))[::-1]
+    return first + (old_errors + new_errors).argmin()
+
+
+def build_offset_map(src_stream, dst_stream):
+    """
+    Matches loudness envelopes of OFFSET_MAP_BLOCK seconds long source blocks against the whole destination.
+    Blocks without a confident match (silence or something missing from the destination) are skipped,
+    places where the offset changes are then located between the blocks.
+    """
+    src_envelope = src_stream.get_envelope(OFFSET_MAP_RATE)
+    dst_envelope = dst_stream.get_envelope(OFFSET_MAP_RATE)
+    block_size = OFFSET_MAP_BLOCK * OFFSET_MAP_RATE
+    segments = []
+    last_block_start = 0
+    for start in xrange(0, len(src_envelope) - block_size + 1, block_size):
+        block = src_envelope[start:start + block_size]
+        if len(dst_envelope) < block_size or block.std() < 1e-6:
+            continue
+        scores = cv2.matchTemplate(dst_envelope.reshape((1, -1)), block.reshape((1, -1)), cv2.TM_CCOEFF_NORMED)[0]
+        best = scores.argmax()
+        if scores[best] < OFFSET_MAP_MIN_SCORE:
+            continue
+        offset = (best - start) / float(OFFSET_MAP_RATE)
+        if not segments:
+            segments.append((0.0, offset))
+        elif abs_diff(segments[-1][1], offset) > OFFSET_MAP_TOLERANCE:
+            change = find_offset_change(src_envelope, dst_envelope, last_block_start, start + block_size,
+                                        segments[-1][1], offset)
+            segments.append((change / float(OFFSET_MAP_RATE), offset))
+        last_block_start = start
+    logging.info('Offset map: {0}'.format(', '.join('{0}: {1:0.2f}'.format(format_time(start), offset)
+                                                    for start, offset in segments)))
+    return OffsetMap(segments)
+
+
+def find_constant_shift(src_stream, dst_stream, groups_list, offset_map):
+    """
+    (shift, diff) of all groups if the destination is just the source delayed by a constant amount, None otherwise.
+    The offset from the offset map is checked on a few random groups at full precision.
+    """
+    if not groups_list or len(offset_map.segments) != 1:
+        return None
+    offset = offset_map.segments[0][1]
+    if any(g[0].start + offset < 0 or g[-1].end + offset > dst_stream.duration_seconds for g in groups_list):
+        return None
+
+    results = []
+    # seeded so every run on the same files checks the same groups
+    for group in random.Random(0).sample(groups_list, min(CONSTANT_SHIFT_SAMPLES, len(groups_list))):
+        start, end = group[0].start, group[-1].end
+        (diff, new_time), left_side_time, right_side_time = dst_stream.find_substream_split(
+            src_stream.get_substream(start, end), start + offset, CONSTANT_SHIFT_WINDOW)
+        if abs_diff(left_side_time, right_side_time) > ALLOWED_ERROR or abs_diff(new_time, left_side_time) > ALLOWED_ERROR:
+            logging.info('{0}-{1}: no clear match, shift is not constant'.format(format_time(start), format_time(end)))
+            return None
+        results.append((new_time - start, diff))
+
+    shift = sorted(s for s, _ in results)[len(results) // 2]
+    if any(abs_diff(s, shift) > ALLOWED_ERROR for s, _ in results):
+        logging.info('Shifts of sampled groups differ, shift is not constant')
+        return None
+    logging.info('Constant shift: {0:0.10f}'.format(shift))
+    return shift, max(diff for _, diff in results)
+
+
+def calculate_shifts(src_stream, dst_stream, groups_list, normal_window, max_window, rewind_thresh, lookahead=0,
+                     offset_map=None, recovery_candidates=False):
+    spans = [(g[0].start, g[-1].end) for g in groups_list]
+    apply_shifts(groups_list, find_shifts(src_stream, dst_stream, spans, normal_window, max_window, rewind_thresh,
+                                          lookahead=lookahead, offset_map=offset_map,
+                                          recovery_candidates=recovery_candidates))
+
+
+def split_spans_by_chapters(spans, chapter_times):
+    """
+    Splits consecutive spans into lists belonging to the same chapter, by the chapter a span starts in
+    """
+    return [list(chapter_spans) for _, chapter_spans in
+            groupby(spans, key=lambda span: bisect.bisect_right(chapter_times, span[0]))]
+
+
+def probe_shift(src_stream, dst_stream, spans, window):
+    """
+    Shift of the first of a few spans whose both halves agree with the whole, None if none of them do
+    """
+    for start, end in spans[:CHAPTER_PROBES]:
+        if start > dst_stream.duration_seconds:
+            break
+        (diff, new_time), left_side_time, right_side_time = dst_stream.find_substream_split(
+            src_stream.get_substream(start, end), start, window)
+        if abs_diff(left_side_time, right_side_time) <= ALLOWED_ERROR and abs_diff(new_time, left_side_time) <= ALLOWED_ERROR:
+            logging.debug('{0}: chapter starts with shift {1:0.5f}'.format(format_time(start), new_time - start))
+            return new_time - start
+    return None
+
+
+# streams of the current chapter worker process, see init_chapter_worker
+chapter_worker_streams = None
+
+
+def init_chapter_worker(src_stream, dst_stream, matcher, interpolate, search_cache):
+    global chapter_worker_streams
+    # the energy index and the pyramid come with the shared stream
+    dst_stream.matcher = matcher
+    dst_stream.interpolate = interpolate
+    if search_cache:
+        dst_stream.enable_search_cache()
+    chapter_worker_streams = src_stream, dst_stream
+
+
+def find_chapter_shifts(spans, probe, normal_window, max_window, rewind_thresh, lookahead, offset_map,
+                        recovery_candidates, initial_shift=0):
+    """
+    States of the chapter, None if probe is set and the shift it starts with couldn't be probed
+    """
+    src_stream, dst_stream = chapter_worker_streams
+    if probe:
+        initial_shift = probe_shift(src_stream, dst_stream, spans, max_window)
+        if initial_shift is None:
+            return None
+    return find_shifts(src_stream, dst_stream, spans, normal_window, max_window, rewind_thresh, initial_shift,
+                       lookahead, offset_map, recovery_candidates)
+
+
+def calculate_shifts_by_chapters(src_stream, dst_stream, groups_list, chapter_times, workers,
+                                 normal_window, max_window, rewind_thresh, lookahead=0, offset_map=None,
+                                 recovery_candidates=False):
+    """
+    Same as calculate_shifts, but every chapter is searched independently on a pool of worker processes.
+    Chapters except the first one start with a shift probed around their first groups instead of the one
+    the previous chapter ended with, unless probing fails and they have to wait for the previous chapter.
+    Both streams are put into shared memory with the energy index and the pyramid of the destination,
+    so workers neither copy nor rebuild them.
+    """
+    spans = [(g[0].start, g[-1].end) for g in groups_list]
+    chapters_spans = split_spans_by_chapters(spans, sorted(chapter_times))
+    if len(chapters_spans) < 2 or workers < 2:
+        return calculate_shifts(src_stream, dst_stream, groups_list, normal_window, max_window, rewind_thresh,
+                                lookahead, offset_map, recovery_candidates)
+
+    shared = []
+    try:
+        try:
+            for stream in (src_stream, dst_stream):
+                shared.append(stream if isinstance(stream, SharedWavStream) else SharedWavStream.publish(stream))
+        except SushiError as e:
+            logging.warning("Can't share audio between processes ({0}), searching chapters one by one".format(e))
+            return calculate_shifts(src_stream, dst_stream, groups_list, normal_window, max_window, rewind_thresh,
+                                    lookahead, offset_map, recovery_candidates)
+
+        workers = min(workers, len(chapters_spans))
+        logging.info('Searching {0} chapters on {1} processes'.format(len(chapters_spans), workers))
+        pool = multiprocessing.Pool(workers, init_chapter_worker,
+                                    (shared[0], shared[1], dst_stream.matcher, dst_stream.interpolate,
+                                     dst_stream.search_cache is not None))
+        try:
+            results = [pool.apply_async(find_chapter_shifts, (chapter_spans, idx > 0, normal_window, max_window,
+                                                               rewind_thresh, lookahead, offset_map,
+                                                               recovery_candidates))
+                       for idx, chapter_spans in enumerate(chapters_spans)]
+            states = []
+            for chapter_spans, result in zip(chapters_spans, results):
+                chapter_states = result.get()
+                if chapter_states is None:
+                    logging.warning("{0}: couldn't probe the shift chapter starts with, continuing from the "
+                                    "previous chapter".format(format_time(chapter_spans[0][0])))
+                    # groups outside of the audio range have no shift
+                    previous_shift = next((s['shift'] for s in reversed(states) if s['shift'] is not None), 0)
+                    chapter_states = pool.apply(find_chapter_shifts, (chapter_spans, False, normal_window, max_window,
+                                                                      rewind_thresh, lookahead, offset_map,
+                                                                      recovery_candidates, previous_shift))
+                states.extend(chapter_states)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    finally:
+        for stream in shared:
+            if stream is not src_stream and stream is not dst_stream:
+                stream.close()
+
+    apply_shifts(groups_list, states)
+
+
 def check_file_exists(path, file_title):
     if path and not os.path.exists(path):
         raise SushiError("{0} file doesn't exist".format(file_title))
@@ -542,6 +911,9 @@ def run(args):
 
     if not ignore_chapters:
         check_file_exists(args.chapters_file, 'Chapters')
+
+    interpolate = args.sample_rate == 'auto'
+    sample_rate = AUTO_SAMPLE_RATE if interpolate else args.sample_rate
     if args.src_keyframes not in ('auto', 'make'):
         check_file_exists(args.src_keyframes, 'Source keyframes')
     if args.dst_keyframes not in ('auto', 'make'):
@@ -561,19 +933,45 @@ def run(args):
 
     create_directory_if_not_exists(args.temp_dir)
 
+    # checking the cache before selecting audio so we don't demux anything we already have
+    cache = WavStreamCache(args.cache_dir, args.cache_size * 1024 * 1024) if args.cache_dir else None
+
+    def get_cache_key(demuxer, stream_idx):
+        if not cache:
+            return None
+        audio_stream = None if demuxer.is_wav else demuxer.get_audio_stream_id(stream_idx)
+        return WavStreamCache.make_key(demuxer.path, sample_rate, args.sample_type, audio_stream)
+
+    src_cache_key = get_cache_key(src_demuxer, args.src_audio_idx)
+    dst_cache_key = get_cache_key(dst_demuxer, args.dst_audio_idx)
+    src_stream = cache.load(src_cache_key) if cache else None
+    dst_stream = cache.load(dst_cache_key) if cache else None
+
+    # decoding only the parts of the source covered by the script needs its duration upfront
+    partial_source = args.partial_audio and not src_demuxer.is_wav and not src_stream
+    if partial_source and src_demuxer.duration is None:
+        logging.warning("Duration of {0} is unknown, decoding all of its audio".format(args.source))
+        partial_source = False
+
     # selecting source audio
-    if src_demuxer.is_wav:
+    if src_demuxer.is_wav or src_stream:
         src_audio_path = args.source
+    elif args.pipe_audio or partial_source:
+        src_audio_path = None
+        src_demuxer.set_audio_pipe(stream_idx=args.src_audio_idx, sample_rate=sample_rate)
     else:
         src_audio_path = format_full_path(args.temp_dir, args.source, '.sushi.wav')
-        src_demuxer.set_audio(stream_idx=args.src_audio_idx, output_path=src_audio_path, sample_rate=args.sample_rate)
+        src_demuxer.set_audio(stream_idx=args.src_audio_idx, output_path=src_audio_path, sample_rate=sample_rate)
 
     # selecting destination audio
-    if dst_demuxer.is_wav:
+    if dst_demuxer.is_wav or dst_stream:
         dst_audio_path = args.destination
+    elif args.pipe_audio:
+        dst_audio_path = None
+        dst_demuxer.set_audio_pipe(stream_idx=args.dst_audio_idx, sample_rate=sample_rate)
     else:
         dst_audio_path = format_full_path(args.temp_dir, args.destination, '.sushi.wav')
-        dst_demuxer.set_audio(stream_idx=args.dst_audio_idx, output_path=dst_audio_path, sample_rate=args.sample_rate)
+        dst_demuxer.set_audio(stream_idx=args.dst_audio_idx, output_path=dst_audio_path, sample_rate=sample_rate)
 
     # selecting source subtitles
     if args.script_file:
@@ -657,22 +1055,108 @@ def run(args):
             dst_timecodes = Timecodes.cfr(args.dst_fps) if args.dst_fps else Timecodes.from_file(dst_timecodes_file)
             dst_keytimes = [dst_timecodes.get_frame_time(f) for f in keyframes.parse_keyframes(dst_keyframes_file)]
 
-        script = AssScript.from_file(src_script_path) if script_extension == '.ass' else SrtScript.from_file(src_script_path)
-        script.sort_by_time()
-
-        src_stream = WavStream(src_audio_path, sample_rate=args.sample_rate, sample_type=args.sample_type)
-        dst_stream = WavStream(dst_audio_path, sample_rate=args.sample_rate, sample_type=args.sample_type)
-
-        search_groups = prepare_search_groups(script.events,
-                                              source_duration=src_stream.duration_seconds,
-                                              chapter_times=chapter_times,
-                                              max_ts_duration=args.max_ts_duration,
-                                              max_ts_distance=args.max_ts_distance)
-
-        calculate_shifts(src_stream, dst_stream, search_groups,
-                         normal_window=args.window,
-                         max_window=args.max_window,
-                         rewind_thresh=args.rewind_thresh if args.grouping else 0)
+        if src_audio_path is None and not partial_source:
+            src_audio_path = RawPcmPipe(src_demuxer.open_audio_pipe(), sample_rate, name=args.source)
+        if dst_audio_path is None:
+            dst_audio_path = RawPcmPipe(dst_demuxer.open_audio_pipe(), sample_rate, name=args.destination)
+
+        def load_script():
+            script = AssScript.from_file(src_script_path) if script_extension == '.ass' else SrtScript.from_file(src_script_path)
+            script.sort_by_time()
+            return script
+
+        def load_stream(audio_path, cache_key):
+            if args.lazy_audio and isinstance(audio_path, basestring):
+                return LazyWavStream(audio_path, sample_rate=sample_rate, sample_type=args.sample_type)
+            if args.max_memory:
+                # the budget is shared by both streams
+                stream = OutOfCoreWavStream(audio_path, sample_rate=sample_rate, sample_type=args.sample_type,
+                                            max_memory=args.max_memory * 1024 * 1024 // 2, temp_dir=args.temp_dir)
+            else:
+                stream = WavStream(audio_path, sample_rate=sample_rate, sample_type=args.sample_type)
+            if cache:
+                cache.store(cache_key, stream)
+            return stream
+
+        def load_source_spans(search_groups):
+            def open_reader(start, end):
+                return RawPcmPipe(src_demuxer.open_audio_pipe(start, end - start), sample_rate,
+                                  name='{0} [{1}-{2}]'.format(args.source, format_time(start), format_time(end)))
+
+            return SparseWavStream(get_source_spans(search_groups, src_demuxer.duration), open_reader,
+                                   src_demuxer.duration, sample_rate=sample_rate, sample_type=args.sample_type)
+
+        def get_search_groups(script, source_duration):
+            return prepare_search_groups(script.events,
+                                         source_duration=source_duration,
+                                         chapter_times=chapter_times,
+                                         max_ts_duration=args.max_ts_duration,
+                                         max_ts_distance=args.max_ts_distance)
+
+        # streams and the script are independent and decoding mostly runs in numpy/cv2 without the GIL
+        pool = ThreadPool(3)
+        src_result = dst_result = None
+        try:
+            script_result = pool.apply_async(load_script)
+            if not dst_stream:
+                dst_result = pool.apply_async(load_stream, (dst_audio_path, dst_cache_key))
+            if partial_source:
+                # only the source audio around search groups is decoded, so the groups are needed first
+                search_groups = get_search_groups(script_result.get(), src_demuxer.duration)
+                src_result = pool.apply_async(load_source_spans, (search_groups,))
+            elif not src_stream:
+                src_result = pool.apply_async(load_stream, (src_audio_path, src_cache_key))
+        finally:
+            pool.close()
+            pool.join()
+            # keeping everything that did load so the finally block below can close it even if something else failed
+            if src_result and src_result.successful():
+                src_stream = src_result.get()
+            if dst_result and dst_result.successful():
+                dst_stream = dst_result.get()
+
+        for result in (src_result, dst_result):
+            if result:
+                result.get()
+        script = script_result.get()
+
+        if not partial_source:
+            search_groups = get_search_groups(script, src_stream.duration_seconds)
+
+        if args.skip_silent:
+            search_groups = link_silent_groups(src_stream, search_groups)
+
+        dst_stream.matcher = args.matcher
+        dst_stream.interpolate = interpolate
+        if args.energy_index:
+            dst_stream.build_energy_index()
+        if args.coarse_search:
+            dst_stream.build_pyramid()
+        if args.search_cache:
+            dst_stream.enable_search_cache()
+        offset_map = build_offset_map(src_stream, dst_stream) if args.offset_map or args.constant_shift else None
+        constant_shift = find_constant_shift(src_stream, dst_stream, search_groups, offset_map) \
+            if args.constant_shift else None
+        if constant_shift:
+            shift, diff = constant_shift
+            apply_shifts(search_groups, [{"shift": shift, "diff": diff}] * len(search_groups))
+        elif args.chapter_workers and chapter_times:
+            calculate_shifts_by_chapters(src_stream, dst_stream, search_groups, chapter_times,
+                                         workers=args.chapter_workers,
+                                         normal_window=args.window,
+                                         max_window=args.max_window,
+                                         rewind_thresh=args.rewind_thresh if args.grouping else 0,
+                                         lookahead=args.lookahead,
+                                         offset_map=offset_map if args.offset_map else None,
+                                         recovery_candidates=args.recovery_candidates)
+        else:
+            calculate_shifts(src_stream, dst_stream, search_groups,
+                             normal_window=args.window,
+                             max_window=args.max_window,
+                             rewind_thresh=args.rewind_thresh if args.grouping else 0,
+                             lookahead=args.lookahead,
+                             offset_map=offset_map if args.offset_map else None,
+                             recovery_candidates=args.recovery_candidates)
 
         events = script.events
 
@@ -680,7 +1164,10 @@ def run(args):
             plt.plot([x.shift for x in events], label='From audio')
 
         if args.grouping:
-            if not ignore_chapters and chapter_times:
+            if constant_shift:
+                # all events already have the same shift, there is nothing to fix or smooth
+                groups = [events]
+            elif not ignore_chapters and chapter_times:
                 groups = groups_from_chapters(events, chapter_times)
                 for g in groups:
                     fix_near_borders(g)
@@ -731,11 +1218,23 @@ def run(args):
             plt.savefig(args.plot_path, dpi=300)
 
     finally:
+        for stream in (src_stream, dst_stream):
+            if stream:
+                stream.close()
         if args.cleanup:
             src_demuxer.cleanup()
             dst_demuxer.cleanup()
 
 
+def parse_sample_rate(value):
+    if value == 'auto':
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid sample rate: '{0}'".format(value))
+
+
 def create_arg_parser():
     parser = argparse.ArgumentParser(description='Sushi - Automatic Subtitle Shifter')
 
@@ -748,6 +1247,27 @@ def create_arg_parser():
                              "and retry with larger window. Set to 0 to disable. [%(default)s]")
     parser.add_argument('--no-grouping', action='store_false', dest='grouping',
                         help="Don't events into groups before shifting. Also disables error recovery.")
+    parser.add_argument('--chapter-workers', default=None, type=int, metavar='<processes>', dest='chapter_workers',
+                        help='Search every chapter independently using this many processes. '
+                             'Error recovery then never crosses chapter borders')
+    parser.add_argument('--offset-map', action='store_true', dest='offset_map',
+                        help='Roughly align loudness of the whole audio first and center searches on the result '
+                             'where the shift changes. Allows using much smaller windows')
+    parser.add_argument('--constant-shift', action='store_true', dest='constant_shift',
+                        help='Check whether the destination audio is just delayed by a constant amount first and '
+                             'shift everything by it without searching every line if it is')
+    parser.add_argument('--search-cache', action='store_true', dest='search_cache',
+                        help='Remember results of all searches so error recovery and overlapping windows only scan '
+                             'the audio that was not scanned yet')
+    parser.add_argument('--recovery-candidates', action='store_true', dest='recovery_candidates',
+                        help='When recovering from errors, accept other good matches of the failed search instead of '
+                             'searching again. Faster, but halves of those matches are only checked near them')
+    parser.add_argument('--lookahead', default=0, type=int, metavar='<groups>', dest='lookahead',
+                        help='Search this many following groups in parallel, assuming the current shift holds. '
+                             'Results are the same as without it. [%(default)s]')
+    parser.add_argument('--skip-silent', action='store_true', dest='skip_silent',
+                        help="Don't search groups with silent source audio, they take the shift of the closest "
+                             "other group instead")
     parser.add_argument('--max-kf-distance', default=2, type=float, metavar='<frames>', dest='max_kf_distance',
                         help='Maximum keyframe snapping distance. [%(default)s]')
     parser.add_argument('--kf-mode', default='all', choices=['shift', 'snap', 'all'], dest='kf_mode',
@@ -766,11 +1286,21 @@ def create_arg_parser():
 
     # deprecated/test options, do not use
     parser.add_argument('--test-shift-plot', default=None, dest='plot_path', help=argparse.SUPPRESS)
-    parser.add_argument('--sample-type', default='uint8', choices=['float32', 'uint8'], dest='sample_type',
-                        help=argparse.SUPPRESS)
 
-    parser.add_argument('--sample-rate', default=12000, type=int, metavar='<rate>', dest='sample_rate',
-                        help='Downsampled audio sample rate. [%(default)s]')
+    parser.add_argument('--sample-rate', default=12000, type=parse_sample_rate, metavar='<rate>', dest='sample_rate',
+                        help='Downsampled audio sample rate, auto uses {0} Hz and interpolates match times between '
+                             'samples. [%(default)s]'.format(AUTO_SAMPLE_RATE))
+    parser.add_argument('--sample-type', default='uint8', choices=WavStream.SAMPLE_TYPES, dest='sample_type',
+                        help='Encoding of the processed audio: linear uint8, float32, float16, mu-law companded '
+                             'uint8 (mulaw) or packed 4-bit (uint4). [%(default)s]')
+    parser.add_argument('--matcher', default='auto', choices=['auto'] + sorted(BACKENDS), dest='matcher',
+                        help='Audio matching backend, auto picks the faster one for every search. [%(default)s]')
+    parser.add_argument('--energy-index', action='store_true', dest='energy_index',
+                        help='Precompute energy of the destination audio once instead of doing it in every search. '
+                             'Makes large windows cheaper at the cost of 8 bytes of memory per sample')
+    parser.add_argument('--coarse-search', action='store_true', dest='coarse_search',
+                        help='Search decimated copies of the destination audio first and match at full rate only '
+                             'around the best candidates. Makes wide windows almost as cheap as small ones')
 
     parser.add_argument('--src-audio', default=None, type=int, metavar='<id>', dest='src_audio_idx',
                         help='Audio stream index of the source video')
@@ -781,6 +1311,21 @@ def create_arg_parser():
     # files
     parser.add_argument('--no-cleanup', action='store_false', dest='cleanup',
                         help="Don't delete demuxed streams")
+    parser.add_argument('--pipe-audio', action='store_true', dest='pipe_audio',
+                        help="Decode audio through a pipe instead of writing temporary WAV files")
+    parser.add_argument('--lazy-audio', action='store_true', dest='lazy_audio',
+                        help='Decode only the parts of WAV audio that are actually searched. '
+                             'Useful for scripts covering a small part of the audio')
+    parser.add_argument('--partial-audio', action='store_true', dest='partial_audio',
+                        help='Decode only the parts of the source audio covered by the script, seeking with ffmpeg. '
+                             'Used when the source is not a WAV file')
+    parser.add_argument('--cache-dir', default=None, dest='cache_dir', metavar='<string>',
+                        help='Folder to cache processed audio streams in, so they are loaded instantly next time')
+    parser.add_argument('--cache-size', default=4096, type=int, metavar='<megabytes>', dest='cache_size',
+                        help='Maximum total size of the audio cache. [%(default)s]')
+    parser.add_argument('--max-memory', default=None, type=int, metavar='<megabytes>', dest='max_memory',
+                        help='Keep processed audio on disk when it takes more than this amount of memory '
+                             'and only read the parts being searched')
     parser.add_argument('--temp-dir', default=None, dest='temp_dir', metavar='<string>',
                         help='Specify temporary folder to use when demuxing stream.')
     parser.add_argument('--chapters', default=None, dest='chapters_file', metavar='<filename>',
@@ -836,6 +1381,8 @@ def parse_args_and_run(cmd_keys):
 
 
 if __name__ == '__main__':
+    # frozen windows builds start the whole executable again in every worker process
+    multiprocessing.freeze_support()
     try:
         parse_args_and_run(sys.argv[1:])
     except SushiError as e:
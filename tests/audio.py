@@ -0,0 +1,843 @@
+import io
+import multiprocessing
+import os
+import pickle
+import struct
+import shutil
+import tempfile
+import threading
+import unittest
+import wave
+import mock
+import numpy as np
+
+import wav as wav_module
+from common import SushiError
+from wav import WavStream, LazyWavStream, OutOfCoreWavStream, SharedWavStream, SparseWavStream, AmplitudeHistogram, WavStreamCache, RawPcmPipe, DownmixedWavFile, Resampler
+
+
+def make_samples(seconds, framerate, channels=1, seed=0):
+    rng = np.random.RandomState(seed)
+    samples = rng.randint(-8000, 8000, seconds * framerate * channels)
+    return samples.astype('<i2')
+
+
+def to_24_bit(samples):
+    widened = (samples.astype('<i4') * 256).view('uint8').reshape((-1, 4))
+    return widened[:, :3].copy()
+
+
+def write_wav(path, samples, framerate, channels=1, sample_width=2):
+    wav = wave.open(path, 'wb')
+    try:
+        wav.setnchannels(channels)
+        wav.setsampwidth(sample_width)
+        wav.setframerate(framerate)
+        wav.writeframes(samples.tostring() if sample_width == 2 else to_24_bit(samples).tostring())
+    finally:
+        wav.close()
+
+
+def write_raw_wav(path, payload, framerate, channels, bits, format_tag=1, container='RIFF', extensible=False):
+    block_align = channels * bits // 8
+    fmt = struct.pack('<HHLLHH', 0xFFFE if extensible else format_tag, channels, framerate,
+                      framerate * block_align, block_align, bits)
+    if extensible:
+        fmt += struct.pack('<HHL', 22, bits, 0x3F) + struct.pack('<H', format_tag) + wav_module.W64_GUID_TAIL[-14:]
+
+    if container == 'W64':
+        def chunk(guid, data):
+            return guid + struct.pack('<Q', len(data) + 24) + data + '\0' * (-len(data) & 7)
+        body = wav_module.W64_WAVE_GUID + chunk(wav_module.W64_FMT_GUID, fmt) + chunk(wav_module.W64_DATA_GUID, payload)
+        content = wav_module.W64_RIFF_GUID + struct.pack('<Q', len(body) + 24) + body
+    elif container == 'RF64':
+        ds64 = struct.pack('<QQQL', 0, len(payload), len(payload) // block_align, 0)
+        content = ('RF64' + struct.pack('<L', 0xFFFFFFFF) + 'WAVE' + 'ds64' + struct.pack('<L', len(ds64)) + ds64 +
+                   'fmt ' + struct.pack('<L', len(fmt)) + fmt + 'data' + struct.pack('<L', 0xFFFFFFFF) + payload)
+    else:
+        body = 'WAVE' + 'fmt ' + struct.pack('<L', len(fmt)) + fmt + 'data' + struct.pack('<L', len(payload)) + payload
+        content = 'RIFF' + struct.pack('<L', len(body)) + body
+
+    with open(path, 'wb') as output:
+        output.write(content)
+
+
+def create_pipe_process(samples, returncode=0):
+    process = mock.Mock()
+    process.stdout = io.BytesIO(samples.tostring())
+    process.wait.return_value = returncode
+    return process
+
+
+class WavTestCase(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.wav')
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+
+class DownmixedWavFileTestCase(WavTestCase):
+    def read_all(self):
+        wav = DownmixedWavFile(self.path)
+        try:
+            return wav.frames_count, wav.readframes(wav.frames_count + 100)
+        finally:
+            wav.close()
+
+    def test_downmixes_16_bit_stereo(self):
+        samples = make_samples(2, 8000, channels=2)
+        write_wav(self.path, samples, 8000, channels=2)
+        frames_count, data = self.read_all()
+        self.assertEqual(frames_count, 16000)
+        expected = samples.reshape((-1, 2)).astype('float32').sum(axis=1) / 2
+        self.assertTrue(np.array_equal(data, expected))
+
+    def test_decodes_24_bit_with_full_precision(self):
+        samples = make_samples(1, 8000)
+        write_wav(self.path, samples, 8000, sample_width=3)
+        frames_count, data = self.read_all()
+        self.assertEqual(frames_count, 8000)
+        self.assertTrue(np.array_equal(data, samples.astype('float32')))
+
+    def test_reads_in_blocks(self):
+        samples = make_samples(1, 8000, channels=2)
+        write_wav(self.path, samples, 8000, channels=2)
+        wav = DownmixedWavFile(self.path)
+        blocks = [wav.readframes(3000) for _ in xrange(4)]
+        wav.close()
+        self.assertEqual([len(b) for b in blocks], [3000, 3000, 2000, 0])
+        self.assertTrue(np.array_equal(np.concatenate(blocks), samples.reshape((-1, 2)).sum(axis=1) / 2.0))
+
+    def test_decodes_float_rf64(self):
+        samples = make_samples(1, 8000, channels=6)
+        payload = (samples.astype('<f4') / 32768).tostring()
+        write_raw_wav(self.path, payload, 8000, channels=6, bits=32, format_tag=3, container='RF64', extensible=True)
+        frames_count, data = self.read_all()
+        self.assertEqual(frames_count, 8000)
+        expected = samples.reshape((-1, 6)).astype('float32').sum(axis=1) / 6
+        self.assertTrue(np.allclose(data, expected, atol=1e-3))
+
+    def test_decodes_32_bit_w64(self):
+        samples = make_samples(1, 8000, channels=2)
+        payload = (samples.astype('<i4') * 65536).tostring()
+        write_raw_wav(self.path, payload + '\0' * 5, 8000, channels=2, bits=32, container='W64')
+        frames_count, data = self.read_all()
+        self.assertEqual(frames_count, 8000)
+        expected = samples.reshape((-1, 2)).astype('float32').sum(axis=1) / 2
+        self.assertTrue(np.array_equal(data, expected))
+
+    def test_decodes_64_bit_float(self):
+        samples = make_samples(1, 8000)
+        write_raw_wav(self.path, (samples / 32768.0).astype('<f8').tostring(), 8000, channels=1, bits=64, format_tag=3)
+        frames_count, data = self.read_all()
+        self.assertTrue(np.array_equal(data, samples.astype('float32')))
+
+    def test_decodes_unsigned_8_bit(self):
+        write_raw_wav(self.path, np.array([0, 128, 255], np.uint8).tostring(), 8000, channels=1, bits=8)
+        frames_count, data = self.read_all()
+        self.assertEqual(list(data), [-32768, 0, 32512])
+
+    def test_rejects_unknown_format(self):
+        write_raw_wav(self.path, '\0' * 16, 8000, channels=1, bits=16, format_tag=2)
+        self.assertRaises(SushiError, DownmixedWavFile, self.path)
+
+    def test_rejects_non_wav_file(self):
+        with open(self.path, 'wb') as output:
+            output.write('\0' * 64)
+        self.assertRaises(SushiError, DownmixedWavFile, self.path)
+
+
+class ResamplerTestCase(unittest.TestCase):
+    @staticmethod
+    def resample(data, src_rate, dst_rate, block_sizes=None, first_output=0):
+        total = -(-len(data) * dst_rate // src_rate)
+        resampler = Resampler(src_rate, dst_rate, first_output=first_output)
+        data = data[resampler.first_input:]
+        blocks = []
+        for size in block_sizes or [len(data)]:
+            blocks.append(resampler.process(data[:size]))
+            data = data[size:]
+        blocks.append(resampler.process(data))
+        blocks.append(resampler.finish(total))
+        return np.concatenate(blocks)
+
+    def test_output_length(self):
+        data = np.zeros(48001, np.float32)
+        self.assertEqual(len(self.resample(data, 48000, 12000)), 12001)
+        self.assertEqual(len(self.resample(data, 44100, 12000)), 13062)
+
+    def test_result_does_not_depend_on_block_sizes(self):
+        data = make_samples(3, 8000).astype(np.float32)
+        for src_rate in (48000, 44100):
+            whole = self.resample(data, src_rate, 12000)
+            blocks = self.resample(data, src_rate, 12000, block_sizes=[1, 7, 1000, 3, 20000])
+            self.assertTrue(np.array_equal(whole, blocks))
+
+    def test_can_start_from_any_output(self):
+        data = make_samples(3, 8000).astype(np.float32)
+        for src_rate in (48000, 44100):
+            whole = self.resample(data, src_rate, 12000)
+            tail = self.resample(data, src_rate, 12000, first_output=777)
+            self.assertTrue(np.array_equal(whole[777:], tail))
+
+    def test_filters_frequencies_above_nyquist(self):
+        time = np.arange(48000) / 48000.0
+        passed = self.resample(np.sin(2 * np.pi * 1000 * time).astype(np.float32), 48000, 12000)
+        filtered = self.resample(np.sin(2 * np.pi * 10000 * time).astype(np.float32), 48000, 12000)
+        self.assertAlmostEqual(np.abs(passed[1000:-1000]).max(), 1.0, places=2)
+        self.assertLess(np.abs(filtered[1000:-1000]).max(), 0.01)
+
+
+class OutOfCoreWavStreamTestCase(WavTestCase):
+    def setUp(self):
+        super(OutOfCoreWavStreamTestCase, self).setUp()
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        write_wav(self.path, make_samples(7, 48000, channels=2), 48000, channels=2)
+        self.in_memory = WavStream(self.path, sample_rate=12000, sample_type='float32')
+
+    def create_stream(self, max_memory):
+        stream = OutOfCoreWavStream(self.path, sample_rate=12000, sample_type='float32', max_memory=max_memory,
+                                    temp_dir=self.temp_dir)
+        self.addCleanup(stream.close)
+        return stream
+
+    def test_returns_same_substreams(self):
+        stream = self.create_stream(max_memory=200000)
+        stream.block_size = 12000
+        stream._blocks.clear()
+        self.assertEqual(len(os.listdir(self.temp_dir)), 1)
+        for start, end in ((-10.0, 0.5), (0.0, 1.0), (1.5, 2.5), (1.0, 5.5), (6.5, 17.0), (-1.0, 8.0)):
+            self.assertTrue(np.array_equal(stream.get_substream(start, end), self.in_memory.get_substream(start, end)))
+        self.assertTrue(np.array_equal(stream.data, self.in_memory.data))
+
+    def test_finds_same_substreams(self):
+        stream = self.create_stream(max_memory=200000)
+        pattern = self.in_memory.get_substream(3.3, 3.8)
+        self.assertEqual(stream.find_substream(pattern, 3.0, 2), self.in_memory.find_substream(pattern, 3.0, 2))
+
+    def test_keeps_limited_number_of_blocks(self):
+        stream = self.create_stream(max_memory=200000)
+        stream.block_size = 12000
+        stream.get_substream(-10.0, 17.0)
+        self.assertEqual(len(stream._blocks), stream._blocks.max_blocks)
+
+    @mock.patch('multiprocessing.cpu_count', lambda: 16)
+    def test_derives_workers_from_max_memory(self):
+        split_output = WavStream._split_output
+        workers = []
+
+        def record_split_output(stream, count):
+            workers.append(count)
+            return split_output(stream, count)
+
+        with mock.patch.object(WavStream, '_split_output', record_split_output):
+            self.create_stream(max_memory=OutOfCoreWavStream.WORKER_MEMORY * 3)
+            self.create_stream(max_memory=200000)
+            self.create_stream(max_memory=OutOfCoreWavStream.WORKER_MEMORY * 100)
+        self.assertEqual(workers, [3, 1, 16])
+
+    def test_is_shared_without_copying(self):
+        stream = self.create_stream(max_memory=200000)
+        shared_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, shared_directory)
+        shared = SharedWavStream.publish(stream, shared_directory)
+        self.assertEqual(len(os.listdir(shared_directory)), 1)
+        self.assertTrue(np.array_equal(pickle.loads(pickle.dumps(shared)).data, self.in_memory.data))
+        shared.close()
+
+    def test_removes_file_on_close(self):
+        stream = self.create_stream(max_memory=200000)
+        stream.close()
+        self.assertEqual(os.listdir(self.temp_dir), [])
+
+    def test_small_streams_are_kept_in_memory(self):
+        stream = self.create_stream(max_memory=10 * 1024 * 1024)
+        self.assertEqual(os.listdir(self.temp_dir), [])
+        self.assertTrue(np.array_equal(stream.get_substream(1.0, 2.0), self.in_memory.get_substream(1.0, 2.0)))
+
+
+def find_in_shared_stream(stream, start, end):
+    # runs in a worker process
+    return stream.find_substream(stream.get_substream(start, end), start, 1.0)
+
+
+class SharedWavStreamTestCase(WavTestCase):
+    def setUp(self):
+        super(SharedWavStreamTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        write_wav(self.path, make_samples(3, 12000), 12000)
+        self.stream = WavStream(self.path, sample_rate=12000)
+        self.shared = SharedWavStream.publish(self.stream, self.directory)
+        self.addCleanup(self.shared.close)
+
+    def test_attached_stream_has_same_data(self):
+        attached = SharedWavStream.attach(self.shared.name)
+        self.assertEqual(attached.sample_count, self.stream.sample_count)
+        self.assertTrue(np.array_equal(attached.get_substream(0.5, 1.5), self.stream.get_substream(0.5, 1.5)))
+        self.assertTrue(isinstance(attached.data, np.memmap))
+
+    def test_pickles_only_the_name(self):
+        pickled = pickle.dumps(self.shared, pickle.HIGHEST_PROTOCOL)
+        self.assertLess(len(pickled), 1000)
+        self.assertTrue(np.array_equal(pickle.loads(pickled).data, self.stream.data))
+
+    def test_works_in_other_processes(self):
+        pool = multiprocessing.Pool(1)
+        try:
+            result = pool.apply(find_in_shared_stream, (self.shared, 1.0, 1.5))
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(result, find_in_shared_stream(self.stream, 1.0, 1.5))
+
+    def test_shares_energy_index_and_pyramid(self):
+        self.stream.build_energy_index()
+        self.stream.build_pyramid()
+        shared = SharedWavStream.publish(self.stream, self.directory)
+        attached = pickle.loads(pickle.dumps(shared, pickle.HIGHEST_PROTOCOL))
+        self.assertTrue(np.array_equal(attached.energy, self.stream.energy))
+        self.assertEqual([factor for factor, _ in attached.pyramid], [factor for factor, _ in self.stream.pyramid])
+        for (_, level), (_, expected) in zip(attached.pyramid, self.stream.pyramid):
+            self.assertTrue(np.array_equal(level, expected))
+        attached.close()
+        shared.close()
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+    def test_attaches_to_memory_mapped_data_without_copying(self):
+        cache = WavStreamCache(os.path.join(self.directory, 'cache'), 10 * 1024 * 1024)
+        cache.store('key', self.stream)
+        shared_directory = os.path.join(self.directory, 'shared')
+        os.mkdir(shared_directory)
+        shared = SharedWavStream.publish(cache.load('key'), shared_directory)
+        self.assertEqual(len(os.listdir(shared_directory)), 1)
+        attached = SharedWavStream.attach(shared.name)
+        self.assertTrue(np.array_equal(attached.data, self.stream.data))
+        attached.close()
+        shared.close()
+        self.assertEqual(os.listdir(shared_directory), [])
+        self.assertIsNotNone(cache.load('key'))
+
+    def test_raises_and_cleans_up_if_writing_fails(self):
+        shared_directory = os.path.join(self.directory, 'shared')
+        os.mkdir(shared_directory)
+        self.stream.build_energy_index()
+        error = IOError(28, 'No space left on device')
+        save_array = SharedWavStream._save_array
+
+        def save_until_full(array, directory, created):
+            if len(created) > 1:
+                raise error
+            return save_array(array, directory, created)
+
+        with mock.patch.object(SharedWavStream, '_save_array', staticmethod(save_until_full)):
+            self.assertRaises(SushiError, SharedWavStream.publish, self.stream, shared_directory)
+        self.assertEqual(os.listdir(shared_directory), [])
+
+    def test_only_owner_removes_data(self):
+        SharedWavStream.attach(self.shared.name).close()
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+        self.shared.close()
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertRaises(SushiError, SharedWavStream.attach, self.shared.name)
+
+
+class SparseWavStreamTestCase(unittest.TestCase):
+    def setUp(self):
+        # clipping values of sparse streams only come from the spans
+        patcher = mock.patch.object(AmplitudeHistogram, 'get_clip_values', lambda self: (-8000.0, 8000.0))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.samples = make_samples(10, 12000)
+        self.full = WavStream(RawPcmPipe(create_pipe_process(self.samples), 12000), sample_rate=12000)
+        self.opened = []
+
+    def open_reader(self, start, end):
+        self.opened.append((start, end))
+        span = self.samples[int(round(start * 12000)):int(round(end * 12000))]
+        return RawPcmPipe(create_pipe_process(span), 12000)
+
+    def create_stream(self, spans, **kwargs):
+        return SparseWavStream(spans, self.open_reader, 10.0, sample_rate=12000, **kwargs)
+
+    def test_decodes_only_spans(self):
+        stream = self.create_stream([(1.0, 2.5), (6.0, 7.0)])
+        self.assertEqual(sorted(self.opened), [(1.0, 2.5), (6.0, 7.0)])
+        self.assertEqual(stream.sample_count, 120000)
+        self.assertEqual(stream.duration_seconds, 10.0)
+
+    def test_returns_same_data_inside_spans(self):
+        stream = self.create_stream([(1.0, 2.5), (6.0, 7.0)], workers=2)
+        for start, end in ((1.0, 2.5), (1.25, 1.75), (6.0, 7.0)):
+            self.assertTrue(np.array_equal(stream.get_substream(start, end), self.full.get_substream(start, end)))
+        pattern = self.full.get_substream(6.2, 6.7)
+        self.assertEqual(stream.find_substream(pattern, 6.0, 0.5)[1], 6.2)
+
+    def test_returns_silence_outside_of_spans(self):
+        stream = self.create_stream([(1.0, 2.5)])
+        silence = stream.get_substream(3.0, 4.0)
+        self.assertTrue(np.all(silence == silence[0, 0]))
+        self.assertTrue(abs(int(silence[0, 0]) - 128) <= 1)
+        partial = stream.get_substream(2.0, 3.0)
+        self.assertTrue(np.array_equal(partial[:, :6000], self.full.get_substream(2.0, 2.5)))
+        self.assertTrue(np.all(partial[:, 6000:] == silence[0, 0]))
+
+    def test_supports_packed_samples(self):
+        stream = self.create_stream([(1.0, 2.5)], sample_type='uint4')
+        full = WavStream(RawPcmPipe(create_pipe_process(self.samples), 12000), sample_rate=12000, sample_type='uint4')
+        self.assertTrue(np.array_equal(stream.get_substream(1.1, 2.0), full.get_substream(1.1, 2.0)))
+
+
+class RawPcmPipeTestCase(WavTestCase):
+    def test_reads_same_data_as_wav_file(self):
+        samples = make_samples(3, 12000)
+        write_wav(self.path, samples, 12000)
+
+        from_file = WavStream(self.path, sample_rate=12000)
+        from_pipe = WavStream(RawPcmPipe(create_pipe_process(samples), 12000), sample_rate=12000)
+
+        self.assertEqual(from_file.sample_count, from_pipe.sample_count)
+        self.assertTrue(np.array_equal(from_file.data, from_pipe.data))
+
+    def test_ignores_incomplete_frame_at_the_end(self):
+        pipe = RawPcmPipe(create_pipe_process(np.array([1, 2, 3], '<i2')), 12000)
+        pipe._process.stdout = io.BytesIO(np.array([1, 2, 3], '<i2').tostring() + b'\x01')
+        self.assertEqual(list(pipe.readframes(10)), [1, 2, 3])
+
+    def test_raises_when_process_fails(self):
+        pipe = RawPcmPipe(create_pipe_process(make_samples(1, 12000), returncode=1), 12000)
+        self.assertRaises(SushiError, lambda: WavStream(pipe, sample_rate=12000))
+
+
+class AmplitudeHistogramTestCase(unittest.TestCase):
+    def test_clip_values_match_medians(self):
+        data = np.random.RandomState(0).randint(-3000, 5000, 100001).astype(np.float32)
+        histogram = AmplitudeHistogram()
+        for chunk in np.array_split(data, 7):
+            histogram.add(chunk)
+        min_value, max_value = histogram.get_clip_values()
+        self.assertEqual(max_value, np.median(data[data >= 0]) * 3)
+        self.assertEqual(min_value, np.median(data[data <= 0]) * 3)
+
+    def test_merged_histograms_give_same_clip_values(self):
+        data = np.random.RandomState(0).randint(-3000, 5000, 100001).astype(np.float32)
+        whole = AmplitudeHistogram()
+        whole.add(data)
+        merged = AmplitudeHistogram()
+        for chunk in np.array_split(data, 3):
+            part = AmplitudeHistogram()
+            part.add(chunk)
+            merged.update(part)
+        self.assertEqual(merged.get_clip_values(), whole.get_clip_values())
+
+    def test_empty_histogram(self):
+        self.assertEqual(AmplitudeHistogram().get_clip_values(), (0.0, 0.0))
+
+
+class WavStreamTestCase(WavTestCase):
+    def test_normalizes_to_uint8(self):
+        samples = make_samples(3, 12000)
+        write_wav(self.path, samples, 12000)
+        stream = WavStream(self.path, sample_rate=12000)
+
+        data = samples.astype(np.float32)
+        max_value = np.median(data[data >= 0]) * 3
+        min_value = np.median(data[data <= 0]) * 3
+        expected = ((np.clip(data, min_value, max_value) - min_value) / (max_value - min_value) * 255 + 0.5)
+
+        self.assertEqual(stream.data.dtype, np.uint8)
+        self.assertEqual(stream.data.shape, (1, 36000 + 2 * 10 * 12000))
+        self.assertTrue(np.array_equal(stream.data[0, 120000:-120000], expected.astype(np.uint8)))
+        self.assertTrue(np.all(stream.data[0, :120000] == stream.data[0, 120000]))
+        self.assertTrue(np.all(stream.data[0, -120000:] == stream.data[0, -120001]))
+
+    def test_float32_stream_is_within_unit_range(self):
+        write_wav(self.path, make_samples(3, 48000), 48000)
+        stream = WavStream(self.path, sample_rate=12000, sample_type='float32')
+        self.assertEqual(stream.data.dtype, np.float32)
+        self.assertEqual(stream.sample_count, 36000)
+        self.assertTrue(0 <= stream.data.min() and stream.data.max() <= 1)
+
+    def test_split_search_is_same_as_separate_searches(self):
+        write_wav(self.path, make_samples(10, 12000), 12000)
+        for sample_type in ('uint8', 'float32'):
+            stream = WavStream(self.path, sample_rate=12000, sample_type=sample_type)
+            # halves coming from different places make all three results differ
+            pattern = np.concatenate((stream.get_substream(2, 2.5), stream.get_substream(6, 6.5)), axis=1)
+            right_offset = 0.5
+            for center, window in ((2, 1.5), (5, 3), (0.1, 1), (9.8, 2), (4, 20)):
+                (diff, time), left_time, right_time = stream.find_substream_split(pattern, center, window)
+                expected_diff, expected_time = stream.find_substream(pattern, center, window)
+                self.assertAlmostEqual(diff, expected_diff, places=4)
+                self.assertAlmostEqual(time, expected_time)
+                self.assertAlmostEqual(left_time, stream.find_substream(pattern[:, :6000], center, window)[1])
+                expected_right = stream.find_substream(pattern[:, 6000:], center + right_offset, window)[1]
+                self.assertAlmostEqual(right_time, expected_right - right_offset)
+            (_, _), left_time, right_time = stream.find_substream_split(pattern, 4, 3)
+            self.assertAlmostEqual(left_time, 2)
+            self.assertAlmostEqual(right_time, 5.5)
+
+    @mock.patch.object(WavStream, 'INDEX_BLOCK_SIZE', 5000)
+    def test_energy_index_gives_same_results(self):
+        write_wav(self.path, make_samples(10, 12000), 12000)
+        for sample_type in ('uint8', 'float32', 'uint4'):
+            stream = WavStream(self.path, sample_rate=12000, sample_type=sample_type)
+            pattern = stream.get_substream(3, 4)
+            searches = [(3.5, 1), (0.2, 2), (9.5, 3)]
+            expected = [(stream.find_substream(pattern, center, window),
+                         stream.find_substream_split(pattern, center, window)) for center, window in searches]
+            stream.build_energy_index()
+            self.assertEqual(len(stream.energy), stream.data.shape[1] * (2 if sample_type == 'uint4' else 1) + 1)
+            for (center, window), (full, split) in zip(searches, expected):
+                diff, time = stream.find_substream(pattern, center, window)
+                self.assertAlmostEqual(diff, full[0], places=4)
+                self.assertAlmostEqual(time, full[1])
+                (diff, time), left_time, right_time = stream.find_substream_split(pattern, center, window)
+                self.assertAlmostEqual(diff, split[0][0], places=4)
+                self.assertEqual((time, left_time, right_time), (split[0][1], split[1], split[2]))
+
+    def test_coarse_to_fine_search_finds_same_substreams(self):
+        write_wav(self.path, make_samples(60, 12000), 12000)
+        for sample_type in ('uint8', 'float32'):
+            stream = WavStream(self.path, sample_rate=12000, sample_type=sample_type)
+            patterns = [(stream.get_substream(t, t + 1), center) for t, center in ((20, 25), (3, 20), (55.5, 30))]
+            expected = [stream.find_substream_split(pattern, center, 30) for pattern, center in patterns]
+            stream.build_pyramid()
+            self.assertEqual([factor for factor, _ in stream.pyramid], [16, 4])
+            self.assertEqual(stream.pyramid[0][1].shape, (1, stream.data.shape[1] // 16))
+            for (pattern, center), ((diff, time), left_time, right_time) in zip(patterns, expected):
+                with mock.patch.object(stream, '_find_substream_coarse_to_fine',
+                                       wraps=stream._find_substream_coarse_to_fine) as coarse_to_fine:
+                    (actual_diff, actual_time), actual_left, actual_right = stream.find_substream_split(pattern, center, 30)
+                    self.assertEqual(coarse_to_fine.call_count, 3)
+                self.assertAlmostEqual(actual_diff, diff, places=4)
+                self.assertEqual((actual_time, actual_left, actual_right), (time, left_time, right_time))
+
+    def test_coarse_to_fine_search_is_not_used_for_small_windows(self):
+        write_wav(self.path, make_samples(10, 12000), 12000)
+        stream = WavStream(self.path, sample_rate=12000)
+        stream.build_pyramid()
+        with mock.patch.object(stream, '_find_substream_coarse_to_fine') as coarse_to_fine:
+            self.assertAlmostEqual(stream.find_substream(stream.get_substream(5, 7), 5.5, 1)[1], 5)
+            self.assertFalse(coarse_to_fine.called)
+
+    @mock.patch.object(WavStream, 'INDEX_BLOCK_SIZE', 1000)
+    def test_envelope_is_deviation_of_blocks(self):
+        samples = make_samples(2, 12000)
+        samples[6000:12000] = 0
+        write_wav(self.path, samples, 12000)
+        stream = WavStream(self.path, sample_rate=12000, sample_type='float32')
+        envelope = stream.get_envelope(100)
+        self.assertEqual(envelope.shape, (200,))
+        audio = stream.data[0, stream.padding_size:stream.padding_size + 24000].reshape((-1, 120))
+        self.assertTrue(np.allclose(envelope, audio.std(axis=1)))
+        self.assertTrue(np.all(envelope[50:100] < 1e-6))
+
+    def test_search_cache_gives_same_results(self):
+        write_wav(self.path, make_samples(20, 12000), 12000)
+        stream = WavStream(self.path, sample_rate=12000)
+        patterns = [stream.get_substream(t, t + 1) for t in (3, 10, 19)]
+        searches = [(0, 3, 1), (0, 3, 5), (1, 10, 2), (1, 11, 4), (0, 4, 10), (2, 19, 3), (2, 18, 2)]
+        expected = [(stream.find_substream(patterns[idx], center, window),
+                     stream.find_substream_split(patterns[idx], center, window)) for idx, center, window in searches]
+        stream.enable_search_cache()
+        for repeat in xrange(2):
+            for (idx, center, window), (full, split) in zip(searches, expected):
+                diff, time = stream.find_substream(patterns[idx], center, window)
+                self.assertAlmostEqual(diff, full[0], places=4)
+                self.assertAlmostEqual(time, full[1])
+                (diff, time), left_time, right_time = stream.find_substream_split(patterns[idx], center, window)
+                self.assertAlmostEqual(diff, split[0][0], places=4)
+                self.assertEqual((time, left_time, right_time), (split[0][1], split[1], split[2]))
+
+    def test_interpolates_match_time_between_samples(self):
+        rate = 4000
+        times = np.arange(5 * rate, dtype=np.float64)
+        rng = np.random.RandomState(0)
+        frequencies, phases = rng.uniform(50, 400, 20), rng.uniform(0, 2 * np.pi, 20)
+
+        def make_signal(delay):
+            return sum(np.sin(2 * np.pi * f * (times - delay) / rate + p) for f, p in zip(frequencies, phases))
+
+        write_wav(self.path, (make_signal(0) * 1000).astype('<i2'), rate)
+        src = WavStream(self.path, sample_rate=rate, sample_type='float32')
+        write_wav(self.path, (make_signal(1.3) * 1000).astype('<i2'), rate)
+        dst = WavStream(self.path, sample_rate=rate, sample_type='float32')
+        pattern = src.get_substream(2, 2.5)
+
+        self.assertAlmostEqual(dst.find_substream(pattern, 2, 1)[1], 2 + 1.0 / rate)
+        dst.interpolate = True
+        self.assertAlmostEqual(dst.find_substream(pattern, 2, 1)[1], 2 + 1.3 / rate, delta=0.1 / rate)
+        (_, time), left_time, right_time = dst.find_substream_split(pattern, 2, 1)
+        for result in (time, left_time, right_time):
+            self.assertAlmostEqual(result, 2 + 1.3 / rate, delta=0.1 / rate)
+
+    def test_loudness_is_relative_to_full_range(self):
+        samples = make_samples(10, 12000)
+        samples[12000:24000] = 0
+        # room tone about 40 dB below the rest
+        samples[36000:48000] //= 100
+        write_wav(self.path, samples, 12000)
+        for sample_type in WavStream.SAMPLE_TYPES:
+            stream = WavStream(self.path, sample_rate=12000, sample_type=sample_type)
+            self.assertLess(stream.get_loudness(1.1, 1.9), 0.01)
+            self.assertGreater(stream.get_loudness(2.1, 2.9), 0.1)
+            self.assertLess(stream.get_loudness(3.1, 3.9), 0.01)
+
+    def test_finds_candidates(self):
+        samples = make_samples(10, 12000)
+        # the same second of audio is repeated 4 seconds later, slightly quieter
+        samples[84000:96000] = samples[36000:48000] * 0.9
+        write_wav(self.path, samples, 12000)
+        stream = WavStream(self.path, sample_rate=12000, sample_type='float32')
+        pattern = stream.get_substream(3, 4)
+
+        candidates = stream.find_substream_candidates(pattern, 5, 4, 3)
+        self.assertEqual(candidates[0], stream.find_substream(pattern, 5, 4))
+        self.assertEqual([round(time, 3) for _, time in candidates[:2]], [3, 7])
+        self.assertEqual(len(candidates), 3)
+        self.assertTrue(candidates[0][0] <= candidates[1][0] <= candidates[2][0])
+
+        split_candidates = stream.find_substream_split_candidates(pattern, 5, 4, 3)
+        self.assertEqual(split_candidates[0], stream.find_substream_split(pattern, 5, 4))
+        (diff, time), left_time, right_time = split_candidates[1]
+        self.assertAlmostEqual(diff, candidates[1][0], places=5)
+        self.assertAlmostEqual(time, 7)
+        self.assertAlmostEqual(left_time, 7)
+        self.assertAlmostEqual(right_time, 7)
+
+    def test_reads_in_small_blocks(self):
+        write_wav(self.path, make_samples(25, 8000, channels=2), 8000, channels=2)
+        readframes = DownmixedWavFile.readframes
+        requested = []
+
+        def record_readframes(reader, count):
+            requested.append(count)
+            return readframes(reader, count)
+
+        with mock.patch.object(DownmixedWavFile, 'readframes', record_readframes):
+            WavStream(self.path, sample_rate=8000, workers=1)
+            # both the histogram and the normalization pass read the whole file
+            self.assertEqual(sum(requested), 2 * 25 * 8000)
+            self.assertEqual(max(requested), WavStream.READ_CHUNK_SIZE * 8000)
+            self.assertLessEqual(WavStream.READ_CHUNK_SIZE, 10)
+
+            # workers share the block size, so memory of blocks being decoded doesn't depend on their count
+            del requested[:]
+            WavStream(self.path, sample_rate=8000, workers=2)
+            self.assertEqual(sum(requested), 2 * 25 * 8000)
+            self.assertEqual(max(requested), WavStream.READ_CHUNK_SIZE * 8000 // 2)
+
+    @mock.patch.object(WavStream, 'READ_CHUNK_SIZE', 1)
+    def test_workers_read_at_least_min_chunk(self):
+        write_wav(self.path, make_samples(25, 8000), 8000)
+        split_output = WavStream._split_output
+        readframes = DownmixedWavFile.readframes
+        parts, requested = [], []
+
+        def record_split_output(stream, count):
+            parts.extend(split_output(stream, count))
+            return parts
+
+        def record_readframes(reader, count):
+            requested.append(count)
+            return readframes(reader, count)
+
+        with mock.patch.object(WavStream, '_split_output', record_split_output), \
+                mock.patch.object(DownmixedWavFile, 'readframes', record_readframes):
+            WavStream(self.path, sample_rate=8000, workers=16)
+        self.assertEqual(len(parts), 16)
+        self.assertEqual(max(requested), WavStream.MIN_CHUNK_SECONDS * 8000)
+
+    @mock.patch.object(WavStream, 'READ_CHUNK_SIZE', 1)
+    def test_parallel_decoding_gives_same_data(self):
+        for framerate in (48000, 44100, 12000, 6000):
+            write_wav(self.path, make_samples(5, framerate, channels=2), framerate, channels=2)
+            single = WavStream(self.path, sample_rate=12000, sample_type='float32', workers=1)
+            parallel = WavStream(self.path, sample_rate=12000, sample_type='float32', workers=4)
+            self.assertEqual(single.sample_count, parallel.sample_count)
+            self.assertTrue(np.array_equal(single.data, parallel.data))
+
+
+class SampleTypesTestCase(WavTestCase):
+    def setUp(self):
+        super(SampleTypesTestCase, self).setUp()
+        write_wav(self.path, make_samples(5, 48000), 48000)
+        self.reference = WavStream(self.path, sample_rate=12000, sample_type='float32')
+
+    def expected(self, start, end, sample_type):
+        normalized = WavStream._normalize(self.reference.get_substream(start, end).copy(), 0.0, 1.0, sample_type)
+        return WavStream._expand(normalized, sample_type)
+
+    @mock.patch.object(WavStream, 'READ_CHUNK_SIZE', 1)
+    def test_returns_encoded_substreams(self):
+        for sample_type in ('float16', 'mulaw', 'uint4'):
+            stream = WavStream(self.path, sample_rate=12000, sample_type=sample_type, workers=3)
+            for start, end in ((-10.0, 0.5), (0.1, 1.00025), (1.00025, 2.5), (3.5, 15.0)):
+                substream = stream.get_substream(start, end)
+                self.assertEqual(substream.dtype, np.float32 if sample_type == 'float16' else np.uint8)
+                self.assertTrue(np.array_equal(substream, self.expected(start, end, sample_type)))
+
+    def test_packs_two_samples_per_byte(self):
+        stream = WavStream(self.path, sample_rate=12000, sample_type='uint4')
+        self.assertEqual(stream.data.nbytes, (60000 + 2 * 120000) // 2)
+        self.assertEqual(stream.get_substream(0, 5).max(), 255)
+
+    def test_mulaw_has_more_levels_for_quiet_samples(self):
+        data = np.array([0.5, 0.51, 0.98, 0.99], np.float32)
+        quiet_low, quiet_high, loud_low, loud_high = WavStream._normalize(data, 0.0, 1.0, 'mulaw').astype(int)
+        self.assertGreater(quiet_high - quiet_low, loud_high - loud_low)
+
+    def test_finds_substreams(self):
+        for sample_type in ('float16', 'mulaw', 'uint4'):
+            stream = WavStream(self.path, sample_rate=12000, sample_type=sample_type)
+            pattern = stream.get_substream(2.25, 2.75)
+            self.assertEqual(stream.find_substream(pattern, 2.0, 1.0)[1], 2.25)
+
+    def test_lazy_and_out_of_core_streams_match(self):
+        stream = WavStream(self.path, sample_rate=12000, sample_type='uint4')
+        # short files are estimated from the whole audio, so lazy clipping values are exact
+        lazy = LazyWavStream(self.path, sample_rate=12000, sample_type='uint4')
+        out_of_core = OutOfCoreWavStream(self.path, sample_rate=12000, sample_type='uint4', max_memory=1000)
+        self.addCleanup(lazy.close)
+        self.addCleanup(out_of_core.close)
+        for start, end in ((-1.0, 0.5), (0.1, 1.00025), (4.0, 6.0)):
+            expected = stream.get_substream(start, end)
+            self.assertTrue(np.array_equal(out_of_core.get_substream(start, end), expected))
+            self.assertTrue(np.array_equal(lazy.get_substream(start, end), expected))
+
+
+class LazyWavStreamTestCase(WavTestCase):
+    def setUp(self):
+        super(LazyWavStreamTestCase, self).setUp()
+        # clipping values of lazy streams are only estimated
+        patcher = mock.patch.object(AmplitudeHistogram, 'get_clip_values', lambda self: (-8000.0, 8000.0))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        write_wav(self.path, make_samples(7, 48000, channels=2), 48000, channels=2)
+        self.eager = WavStream(self.path, sample_rate=12000)
+
+    def create_lazy(self, **kwargs):
+        lazy = LazyWavStream(self.path, sample_rate=12000, **kwargs)
+        lazy.BLOCK_SECONDS = 2
+        lazy.block_size = 2 * 12000
+        self.addCleanup(lazy.close)
+        return lazy
+
+    def test_returns_same_substreams(self):
+        lazy = self.create_lazy()
+        self.assertEqual(lazy.sample_count, self.eager.sample_count)
+        for start, end in ((-3.0, 0.5), (0.0, 1.0), (1.5, 2.5), (1.0, 5.5), (6.5, 9.0), (-1.0, 8.0)):
+            self.assertTrue(np.array_equal(lazy.get_substream(start, end), self.eager.get_substream(start, end)))
+
+    def test_finds_same_substreams(self):
+        lazy = self.create_lazy()
+        pattern = self.eager.get_substream(3.3, 3.8)
+        self.assertEqual(lazy.find_substream(pattern, 3.0, 2), self.eager.find_substream(pattern, 3.0, 2))
+
+    def test_keeps_limited_number_of_blocks(self):
+        lazy = self.create_lazy(max_blocks=2)
+        lazy.get_substream(0.0, 7.0)
+        self.assertEqual(len(lazy._blocks), 2)
+
+    def test_reads_cached_blocks_while_decoding(self):
+        lazy = self.create_lazy()
+        cached = lazy.get_substream(0.0, 1.0)
+        decode_range = lazy._decode_range
+        started, release = threading.Event(), threading.Event()
+        decoded = []
+
+        def slow_decode_range(start, end):
+            decoded.append(start)
+            started.set()
+            release.wait()
+            return decode_range(start, end)
+
+        lazy._decode_range = slow_decode_range
+        readers = [threading.Thread(target=lazy.get_substream, args=(4.5, 5.0)) for _ in xrange(2)]
+        for reader in readers:
+            reader.start()
+        started.wait()
+        try:
+            self.assertTrue(np.array_equal(lazy.get_substream(0.0, 1.0), cached))
+        finally:
+            release.set()
+            for reader in readers:
+                reader.join()
+        self.assertEqual(decoded, [2 * lazy.block_size])
+
+    def test_prefetches_blocks_in_background(self):
+        lazy = self.create_lazy()
+        lazy.prefetch(2.5, 5.0)
+        lazy._prefetch_queue.put(None)
+        lazy._prefetch_thread.join()
+        lazy._prefetch_thread = None
+        self.assertEqual(sorted(lazy._blocks.keys()), [1, 2])
+
+
+class WavStreamCacheTestCase(WavTestCase):
+    def setUp(self):
+        super(WavStreamCacheTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        write_wav(self.path, make_samples(2, 12000), 12000)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(WavStreamCacheTestCase, self).tearDown()
+
+    def test_returns_none_on_miss(self):
+        cache = WavStreamCache(self.directory, 10 * 1024 * 1024)
+        self.assertIsNone(cache.load(WavStreamCache.make_key(self.path, 12000, 'uint8')))
+
+    def test_loads_stored_stream(self):
+        cache = WavStreamCache(self.directory, 10 * 1024 * 1024)
+        stream = WavStream(self.path, sample_rate=12000)
+        key = WavStreamCache.make_key(self.path, 12000, 'uint8')
+        cache.store(key, stream)
+
+        loaded = cache.load(key)
+        self.assertEqual(loaded.sample_count, stream.sample_count)
+        self.assertEqual(loaded.duration_seconds, stream.duration_seconds)
+        self.assertTrue(np.array_equal(loaded.data, stream.data))
+        pattern = stream.get_substream(1.0, 1.2)
+        self.assertEqual(loaded.find_substream(pattern, 1.0, 0.5), stream.find_substream(pattern, 1.0, 0.5))
+
+    def test_store_failures_are_not_fatal(self):
+        cache = WavStreamCache(self.directory, 10 * 1024 * 1024)
+        stream = WavStream(self.path, sample_rate=12000)
+        with mock.patch.object(wav_module.np, 'save', side_effect=IOError('No space left on device')):
+            cache.store('first', stream)
+        self.assertIsNone(cache.load('first'))
+        self.assertEqual([name for name in os.listdir(self.directory) if name.endswith('.tmp')], [])
+
+    def test_overwrites_existing_entries(self):
+        cache = WavStreamCache(self.directory, 10 * 1024 * 1024)
+        cache.store('first', WavStream(self.path, sample_rate=12000))
+        stream = WavStream(self.path, sample_rate=8000)
+        cache.store('first', stream)
+        self.assertEqual(cache.load('first').sample_count, stream.sample_count)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['first.json', 'first.npy'])
+
+    def test_key_depends_on_parameters(self):
+        keys = {WavStreamCache.make_key(self.path, 12000, 'uint8'),
+                WavStreamCache.make_key(self.path, 8000, 'uint8'),
+                WavStreamCache.make_key(self.path, 12000, 'float32'),
+                WavStreamCache.make_key(self.path, 12000, 'uint8', audio_stream=1)}
+        self.assertEqual(len(keys), 4)
+
+    def test_evicts_least_recently_used(self):
+        stream = WavStream(self.path, sample_rate=12000)
+        cache = WavStreamCache(self.directory, int(stream.data.nbytes * 2.5))
+        cache.store('first', stream)
+        cache.store('second', stream)
+        os.utime(os.path.join(self.directory, 'first.npy'), (0, 0))
+        os.utime(os.path.join(self.directory, 'second.npy'), (1, 1))
+        cache.load('first')
+        cache.store('third', stream)
+
+        self.assertIsNotNone(cache.load('first'))
+        self.assertIsNone(cache.load('second'))
+        self.assertIsNotNone(cache.load('third'))
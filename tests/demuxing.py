@@ -90,6 +90,30 @@ class FFmpegTestCase(unittest.TestCase):
                                    '-map', '0:2', 'out0.ass',
                                    '-map', '0:0', '-f', 'mkvtimestamp_v2', 'tcs0.txt'])
 
+    @mock.patch('subprocess.Popen')
+    def test_open_audio_pipe_call_args(self, popen_mock):
+        FFmpeg.open_audio_pipe('random.mkv', audio_stream=1, audio_rate=12000)
+        self.assertEquals(popen_mock.call_args[0][0], ['ffmpeg', '-hide_banner', '-i', 'random.mkv', '-map', '0:1',
+                                                       '-ar', '12000', '-ac', '1', '-acodec', 'pcm_s16le',
+                                                       '-f', 's16le', '-'])
+
+    @mock.patch('subprocess.Popen', new_callable=create_popen_mock)
+    def test_open_audio_pipe_with_seeking(self, popen_mock):
+        FFmpeg.open_audio_pipe('random.mkv', audio_stream=1, audio_rate=12000, start=61.5, duration=10)
+        self.assertEquals(popen_mock.call_args[0][0], ['ffmpeg', '-hide_banner', '-ss', '61.500', '-t', '10.000',
+                                                       '-i', 'random.mkv', '-map', '0:1', '-ar', '12000', '-ac', '1',
+                                                       '-acodec', 'pcm_s16le', '-f', 's16le', '-'])
+
+    def test_parses_duration(self):
+        self.assertEqual(FFmpeg._get_duration('  Duration: 00:23:40.05, start: 0.000000, bitrate: 1714 kb/s'),
+                         1420.05)
+        self.assertIsNone(FFmpeg._get_duration('  Duration: N/A, bitrate: N/A'))
+
+    @mock.patch('subprocess.Popen')
+    def test_open_audio_pipe_fail_when_no_ffmpeg(self, popen_mock):
+        popen_mock.side_effect = OSError(2, "ignored")
+        self.assertRaises(SushiError, lambda: FFmpeg.open_audio_pipe('random.mkv', 1, 12000))
+
 
 class MkvExtractTestCase(unittest.TestCase):
     @mock.patch('subprocess.call')
@@ -1,10 +1,13 @@
 from collections import namedtuple
 import os
+import pickle
 import re
 import unittest
-from mock import patch, ANY
+from mock import patch, ANY, MagicMock
+import numpy as np
 from common import SushiError, format_time
 import sushi
+from wav import WavStream, SharedWavStream
 
 here = os.path.dirname(os.path.abspath(__file__))
 
@@ -181,6 +184,248 @@ class GetDistanceToClosestKeyframeTestCase(unittest.TestCase):
         self.assertEqual(sushi.get_distance_to_closest_kf(36, self.KEYTIMES), 4)
 
 
+class GetSourceSpansTestCase(unittest.TestCase):
+    @staticmethod
+    def group(start, end):
+        return [FakeEvent(start=start, end=(start + end) / 2.0), FakeEvent(start=(start + end) / 2.0, end=end)]
+
+    def test_adds_margins_and_clips_to_duration(self):
+        spans = sushi.get_source_spans([self.group(0.5, 3), self.group(95, 99.5)], 100)
+        self.assertEqual(spans, [(0, 4), (94, 100)])
+
+    def test_merges_close_and_overlapping_groups(self):
+        groups = [self.group(10, 20), self.group(15, 18), self.group(24, 30), self.group(50, 60)]
+        self.assertEqual(sushi.get_source_spans(groups, 100), [(9, 31), (49, 61)])
+
+    def test_skips_groups_outside_of_audio(self):
+        self.assertEqual(sushi.get_source_spans([self.group(120, 130)], 100), [])
+
+
+def make_stream(samples, sample_rate):
+    padding = np.repeat(samples[:1], WavStream.PADDING_SECONDS * sample_rate)
+    data = np.concatenate((padding, samples, padding)).reshape((1, -1))
+    return WavStream.from_array(data, sample_rate, len(samples), 'uint8')
+
+
+class ChapterShiftsTestCase(unittest.TestCase):
+    # destination is the source delayed by 2 seconds in the first chapter and by 5 seconds in the second one
+    def setUp(self):
+        rate = 1000
+        src = np.random.RandomState(0).randint(0, 256, 120 * rate).astype(np.uint8)
+        dst = np.concatenate((np.zeros(2 * rate), src[:60 * rate], np.zeros(3 * rate), src[60 * rate:]))
+        self.src_stream = make_stream(src, rate)
+        self.dst_stream = make_stream(dst.astype(np.uint8), rate)
+        self.chapter_times = [0, 60]
+        self.groups = [[FakeEvent(start=t, end=t + 1.5)] for t in (5, 20, 40, 55, 62, 80, 100, 110)]
+
+    def test_splits_spans_by_chapter_start(self):
+        spans = [(0, 5), (5, 61), (62, 70), (130, 140), (150, 160)]
+        self.assertEqual(sushi.split_spans_by_chapters(spans, [0, 60, 130]),
+                         [[(0, 5), (5, 61)], [(62, 70)], [(130, 140), (150, 160)]])
+
+    def test_probes_shift_of_chapter(self):
+        spans = [(62, 63.5), (80, 81.5)]
+        self.assertAlmostEqual(sushi.probe_shift(self.src_stream, self.dst_stream, spans, 10), 5)
+        self.assertIsNone(sushi.probe_shift(self.src_stream, self.dst_stream, spans, 1))
+
+    def test_find_shifts_starts_with_initial_shift(self):
+        spans = [(62, 63.5), (80, 81.5)]
+        states = sushi.find_shifts(self.src_stream, self.dst_stream, spans, normal_window=1, max_window=1,
+                                   rewind_thresh=0, initial_shift=5)
+        self.assertEqual([(s['start_time'], round(s['shift'], 3)) for s in states], [(62, 5), (80, 5)])
+
+    def test_lookahead_gives_same_states(self):
+        spans = [(g[0].start, g[-1].end) for g in self.groups]
+        expected = sushi.find_shifts(self.src_stream, self.dst_stream, spans, normal_window=10, max_window=30,
+                                     rewind_thresh=5)
+        with patch.object(sushi.SpeculativeSearches, '_search', autospec=True,
+                          side_effect=sushi.SpeculativeSearches._search) as search:
+            states = sushi.find_shifts(self.src_stream, self.dst_stream, spans, normal_window=10, max_window=30,
+                                       rewind_thresh=5, lookahead=3)
+            speculated = [call[0][1:] for call in search.call_args_list]
+        self.assertEqual(states, expected)
+        # groups after the shift change are first searched around the old shift
+        self.assertIn((5, 2), speculated)
+        self.assertIn((5, 5), speculated)
+
+    def test_speculative_results_survive_float_noise_in_shifts(self):
+        spans = [(g[0].start, g[-1].end) for g in self.groups]
+        searches = sushi.SpeculativeSearches(self.src_stream, self.dst_stream, spans, 1.5, 2)
+        try:
+            with patch.object(sushi.SpeculativeSearches, '_search', autospec=True,
+                              side_effect=sushi.SpeculativeSearches._search) as search:
+                searches.dispatch(0, 2.0000000000000004)
+                diff, time = searches.get(1, 1.9999999999999998)
+            # only the speculative searches were run
+            self.assertTrue(all(call[0][2] == 2.0000000000000004 for call in search.call_args_list))
+        finally:
+            searches.close()
+        expected = self.dst_stream.find_substream(self.src_stream.get_substream(*spans[1]), spans[1][0] + 2, 1.5)
+        self.assertAlmostEqual(diff, expected[0])
+        self.assertAlmostEqual(time, expected[1])
+
+    def test_doesnt_speculate_without_small_window_searches(self):
+        spans = [(g[0].start, g[-1].end) for g in self.groups]
+        with patch.object(sushi.SpeculativeSearches, '_search', autospec=True) as search:
+            sushi.find_shifts(self.src_stream, self.dst_stream, spans, normal_window=1, max_window=1, rewind_thresh=5,
+                              lookahead=3)
+        self.assertFalse(search.called)
+
+    def test_recovers_using_candidates_of_the_same_search(self):
+        src_stream = MagicMock()
+        dst_stream = MagicMock(duration_seconds=1000)
+        dst_stream.find_substream.return_value = (0.5, 100)
+        dst_stream.find_substream_split_candidates.side_effect = [
+            [((0.3, 13), 12, 14)],
+            [((0.2, 40), 41, 39), ((0.25, 23), 23, 23)],
+        ]
+        states = sushi.find_shifts(src_stream, dst_stream, [(10, 11), (20, 21)], normal_window=10, max_window=10,
+                                   rewind_thresh=0, recovery_candidates=True)
+        self.assertEqual([s['shift'] for s in states], [3, 3])
+        self.assertFalse(dst_stream.find_substream_split.called)
+
+    def test_recovers_by_searching_again_by_default(self):
+        src_stream = MagicMock()
+        dst_stream = MagicMock(duration_seconds=1000)
+        dst_stream.find_substream.return_value = (0.5, 100)
+        dst_stream.find_substream_split.side_effect = [((0.3, 13), 12, 14), ((0.2, 40), 41, 39), ((0.25, 23), 23, 23)]
+        states = sushi.find_shifts(src_stream, dst_stream, [(10, 11), (20, 21)], normal_window=10, max_window=10,
+                                   rewind_thresh=0)
+        self.assertEqual([s['shift'] for s in states], [3, 3])
+        self.assertFalse(dst_stream.find_substream_split_candidates.called)
+        self.assertEqual(dst_stream.find_substream_split.call_count, 3)
+
+    def test_calculates_chapters_in_parallel(self):
+        sushi.calculate_shifts_by_chapters(self.src_stream, self.dst_stream, self.groups, self.chapter_times,
+                                           workers=2, normal_window=10, max_window=30, rewind_thresh=5)
+        self.assertEqual([round(g[0].shift, 3) for g in self.groups], [2, 2, 2, 2, 5, 5, 5, 5])
+
+    def test_searches_chapters_one_by_one_if_audio_cant_be_shared(self):
+        with patch.object(SharedWavStream, '_save_array', side_effect=IOError(28, 'No space left on device')), \
+                patch('multiprocessing.Pool') as pool:
+            sushi.calculate_shifts_by_chapters(self.src_stream, self.dst_stream, self.groups, self.chapter_times,
+                                               workers=2, normal_window=10, max_window=30, rewind_thresh=5)
+        self.assertFalse(pool.called)
+        self.assertEqual([round(g[0].shift, 3) for g in self.groups], [2, 2, 2, 2, 5, 5, 5, 5])
+
+    def test_workers_use_index_and_pyramid_of_the_parent(self):
+        self.dst_stream.build_energy_index()
+        self.dst_stream.build_pyramid()
+        shared = SharedWavStream.publish(self.dst_stream)
+        self.addCleanup(shared.close)
+        self.addCleanup(setattr, sushi, 'chapter_worker_streams', None)
+        with patch.object(WavStream, 'build_energy_index') as build_energy_index, \
+                patch.object(WavStream, 'build_pyramid') as build_pyramid:
+            sushi.init_chapter_worker(self.src_stream, pickle.loads(pickle.dumps(shared)), 'auto', False, False)
+        worker_stream = sushi.chapter_worker_streams[1]
+        self.assertFalse(build_energy_index.called)
+        self.assertFalse(build_pyramid.called)
+        self.assertTrue(np.array_equal(worker_stream.energy, self.dst_stream.energy))
+        self.assertEqual(len(worker_stream.pyramid), len(self.dst_stream.pyramid))
+
+        sushi.calculate_shifts_by_chapters(self.src_stream, self.dst_stream, self.groups, self.chapter_times,
+                                           workers=2, normal_window=10, max_window=30, rewind_thresh=5)
+        self.assertEqual([round(g[0].shift, 3) for g in self.groups], [2, 2, 2, 2, 5, 5, 5, 5])
+
+    def test_continues_from_previous_chapter_if_probing_fails(self):
+        with patch('sushi.probe_shift', return_value=None), patch('sushi.logging.warning') as warning:
+            sushi.calculate_shifts_by_chapters(self.src_stream, self.dst_stream, self.groups, self.chapter_times,
+                                               workers=2, normal_window=10, max_window=30, rewind_thresh=5)
+        self.assertEqual([round(g[0].shift, 3) for g in self.groups], [2, 2, 2, 2, 5, 5, 5, 5])
+        self.assertTrue(warning.called)
+
+    def test_continues_after_chapter_outside_of_audio_if_probing_fails(self):
+        # destination only has the first 50 seconds of the source
+        dst_stream = make_stream(self.dst_stream.get_substream(0, 52)[0], 1000)
+        groups = self.groups[:6]
+        with patch('sushi.probe_shift', return_value=None):
+            sushi.calculate_shifts_by_chapters(self.src_stream, dst_stream, groups, self.chapter_times,
+                                               workers=2, normal_window=10, max_window=30, rewind_thresh=5)
+        self.assertEqual([round(g[0].shift, 3) for g in groups[:3]], [2, 2, 2])
+
+    def test_falls_back_to_sequential_search_for_single_chapter(self):
+        with patch('multiprocessing.Pool') as pool:
+            sushi.calculate_shifts_by_chapters(self.src_stream, self.dst_stream, self.groups, [0],
+                                               workers=2, normal_window=10, max_window=30, rewind_thresh=5)
+            self.assertFalse(pool.called)
+        self.assertEqual([round(g[0].shift, 3) for g in self.groups], [2, 2, 2, 2, 5, 5, 5, 5])
+
+
+class OffsetMapTestCase(unittest.TestCase):
+    # bursty noise, destination starts 2 seconds later and gets 3 more seconds of something else after 100 seconds
+    def setUp(self):
+        rate = 1000
+        rng = np.random.RandomState(0)
+        loudness = np.repeat(rng.rand(200 * 10) * (rng.rand(200 * 10) > 0.3), rate // 10)
+        src = 128 + rng.randn(200 * rate) * loudness * 40
+        dst = np.concatenate((np.full(2 * rate, 128), src[:100 * rate], 128 + rng.randn(3 * rate) * 30, src[100 * rate:]))
+        self.src_stream = make_stream(np.clip(src, 0, 255).astype(np.uint8), rate)
+        self.dst_stream = make_stream(np.clip(dst, 0, 255).astype(np.uint8), rate)
+
+    def test_get_shift(self):
+        offset_map = sushi.OffsetMap([(0, 1.0), (50, 2.0)])
+        self.assertEqual([offset_map.get_shift(t) for t in (-5, 0, 49.9, 50, 1000)], [1.0, 1.0, 1.0, 2.0, 2.0])
+        self.assertIsNone(sushi.OffsetMap([]).get_shift(10))
+
+    def test_finds_offsets_and_where_they_change(self):
+        offset_map = sushi.build_offset_map(self.src_stream, self.dst_stream)
+        self.assertEqual([(round(start), round(offset, 2)) for start, offset in offset_map.segments], [(0, 2), (100, 5)])
+
+    def test_finds_constant_shift(self):
+        groups = [[FakeEvent(start=t, end=t + 1.5)] for t in xrange(10, 90, 5)]
+        offset_map = sushi.build_offset_map(self.src_stream, self.dst_stream)
+        self.assertIsNone(sushi.find_constant_shift(self.src_stream, self.dst_stream, groups, offset_map))
+        # only the part before the jump
+        shift, diff = sushi.find_constant_shift(self.src_stream, self.dst_stream, groups, sushi.OffsetMap([(0, 2.05)]))
+        self.assertAlmostEqual(shift, 2)
+        self.assertLess(diff, 0.01)
+
+    def test_rejects_constant_shift_not_matching_all_groups(self):
+        groups = [[FakeEvent(start=t, end=t + 1.5)] for t in xrange(10, 190, 5)]
+        offset_map = sushi.OffsetMap([(0, 2.0)])
+        self.assertIsNone(sushi.find_constant_shift(self.src_stream, self.dst_stream, groups, offset_map))
+        # groups after the jump fit, but the last one would be past the end of the destination
+        groups = [[FakeEvent(start=t, end=t + 1.5)] for t in (110, 150, 190, 201)]
+        self.assertIsNone(sushi.find_constant_shift(self.src_stream, self.dst_stream, groups, sushi.OffsetMap([(0, 5.0)])))
+        self.assertIsNotNone(sushi.find_constant_shift(self.src_stream, self.dst_stream, groups[:-1],
+                                                       sushi.OffsetMap([(0, 5.0)])))
+
+    def test_centers_searches_on_offset_map(self):
+        spans = [(t, t + 1.5) for t in xrange(10, 190, 10)]
+        offset_map = sushi.OffsetMap([(0, 2.0), (100, 5.0)])
+        with patch('logging.warn') as warn:
+            states = sushi.find_shifts(self.src_stream, self.dst_stream, spans, normal_window=1, max_window=10,
+                                       rewind_thresh=3, offset_map=offset_map)
+            self.assertFalse(warn.called)
+        self.assertEqual([round(s['shift'], 3) for s in states], [2] * 9 + [5] * 9)
+
+
+class LinkSilentGroupsTestCase(unittest.TestCase):
+    # source audio is silent between 20 and 30 and between 60 and 70 seconds
+    def setUp(self):
+        samples = np.random.RandomState(0).randint(0, 256, 100 * 100).astype(np.uint8)
+        samples[2000:3000] = 128
+        samples[6000:7000] = 128
+        self.stream = make_stream(samples, 100)
+
+    @staticmethod
+    def group(start, end):
+        return [FakeEvent(start=start, end=(start + end) / 2.0), FakeEvent(start=(start + end) / 2.0, end=end)]
+
+    def test_links_silent_groups_to_closest_group(self):
+        groups = [self.group(10, 15), self.group(21, 25), self.group(40, 45), self.group(61, 64), self.group(70, 80)]
+        passed = sushi.link_silent_groups(self.stream, groups)
+        self.assertEqual(passed, [groups[0], groups[2], groups[4]])
+        self.assertTrue(all(e.linked is groups[0][-1] for e in groups[1]))
+        self.assertTrue(all(e.linked is groups[4][0] for e in groups[3]))
+        self.assertTrue(all(not e.linked for g in passed for e in g))
+
+    def test_keeps_groups_if_all_are_silent(self):
+        groups = [self.group(21, 25), self.group(61, 64)]
+        self.assertEqual(sushi.link_silent_groups(self.stream, groups), groups)
+        self.assertTrue(all(not e.linked for g in groups for e in g))
+
+
 @patch('sushi.check_file_exists')
 class MainScriptTestCase(unittest.TestCase):
     @staticmethod
@@ -204,6 +449,13 @@ class MainScriptTestCase(unittest.TestCase):
         mock_object.assert_any_call('dst-tcs', ANY)
         mock_object.assert_any_call('src-tcs', ANY)
 
+    def test_parses_auto_sample_rate(self, ignore):
+        parser = sushi.create_arg_parser()
+        keys = ['--src', 's.wav', '--dst', 'd.wav']
+        self.assertEqual(parser.parse_args(keys + ['--sample-rate', 'auto']).sample_rate, 'auto')
+        self.assertEqual(parser.parse_args(keys + ['--sample-rate', '8000']).sample_rate, 8000)
+        self.assertEqual(parser.parse_args(keys).sample_rate, 12000)
+
     def test_raises_on_unknown_script_type(self, ignore):
         keys = ['--src', 's.wav', '--dst', 'd.wav', '--script', 's.mp4']
         self.assertRaisesRegexp(SushiError, self.any_case_regex(r'script.*type'), lambda: sushi.parse_args_and_run(keys))
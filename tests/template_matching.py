@@ -0,0 +1,146 @@
+import unittest
+import numpy as np
+
+from common import SushiError
+from matching import match_template, match_cv2, match_fft, select_backend, decimate, select_candidates, \
+    select_minima, interpolate_minimum, merge_ranges, ScoreCache, FFT_MIN_WORK
+
+
+def make_audio(size, dtype, seed=0):
+    walk = np.cumsum(np.random.RandomState(seed).randn(size))
+    walk = (walk - walk.min()) / (walk.max() - walk.min())
+    if dtype == np.uint8:
+        return (walk * 255).astype(np.uint8).reshape((1, -1))
+    return walk.astype(np.float32).reshape((1, -1))
+
+
+class FftMatcherTestCase(unittest.TestCase):
+    def assert_same_as_cv2(self, source, pattern, check_best=True):
+        expected = match_cv2(source, pattern)
+        actual = match_fft(source, pattern)
+        self.assertEqual(actual.shape, expected.shape)
+        self.assertEqual(actual.dtype, np.float32)
+        self.assertTrue(np.allclose(actual, expected, atol=1e-5))
+        if check_best:
+            self.assertEqual(actual.argmin(), expected.argmin())
+
+    def test_same_scores_as_cv2(self):
+        for dtype in (np.uint8, np.float32):
+            for pattern_size, window_size in ((100, 5000), (3000, 3000), (6000, 40000), (20000, 1000)):
+                source = make_audio(pattern_size + window_size, dtype)
+                pattern = source[:, 1234 % window_size:1234 % window_size + pattern_size].copy()
+                self.assert_same_as_cv2(source, pattern)
+
+    def test_same_scores_for_pattern_from_other_audio(self):
+        source = make_audio(50000, np.uint8, seed=1)
+        pattern = np.clip(source[:, 7000:17000].astype(int) + np.random.RandomState(2).randint(-5, 6, 10000), 0, 255)
+        self.assert_same_as_cv2(source, pattern.astype(np.uint8))
+
+    def test_clamps_like_cv2(self):
+        source = np.zeros((1, 3000), np.float32)
+        source[0, 2000:] = 1
+        pattern = make_audio(500, np.float32)
+        result = match_fft(source, pattern)
+        self.assertTrue(np.all(result[0, :1500] == 1))
+        # the constant part has lots of equally good positions
+        self.assert_same_as_cv2(source, pattern, check_best=False)
+
+    def test_raises_on_short_window(self):
+        self.assertRaises(SushiError, match_fft, make_audio(100, np.float32), make_audio(200, np.float32))
+
+
+class MatchTemplateTestCase(unittest.TestCase):
+    def test_selects_fft_for_large_searches(self):
+        self.assertEqual(select_backend(1000, 10000), 'cv2')
+        self.assertEqual(select_backend(120000, FFT_MIN_WORK / 120000), 'fft')
+
+    def test_uses_requested_backend(self):
+        source = make_audio(20000, np.float32)
+        pattern = source[:, 5000:8000].copy()
+        for backend in ('auto', 'cv2', 'fft'):
+            self.assertEqual(match_template(source, pattern, backend).argmin(), 5000)
+
+    def test_raises_on_unknown_backend(self):
+        source = make_audio(2000, np.float32)
+        self.assertRaises(SushiError, match_template, source, source[:, :100], 'magic')
+
+
+class PyramidHelpersTestCase(unittest.TestCase):
+    def test_decimate_averages_and_drops_tail(self):
+        samples = np.array([[0, 2, 4, 6, 8, 10, 12]], np.uint8)
+        result = decimate(samples, 2)
+        self.assertEqual(result.dtype, np.float32)
+        self.assertEqual(result.tolist(), [[1, 5, 9]])
+
+    def test_select_candidates_skips_neighbours_of_better_ones(self):
+        scores = np.array([0.5, 0.1, 0.2, 0.9, 0.3, 0.15])
+        positions = np.array([0, 10, 11, 20, 30, 40])
+        self.assertEqual(select_candidates(scores, positions, 3, 2), [10, 40, 30])
+        self.assertEqual(select_candidates(scores, positions, 10, 2), [10, 40, 30, 0, 20])
+
+    def test_select_minima_finds_separated_local_minima(self):
+        scores = np.ones(100, np.float32)
+        scores[[10, 12, 50, 97]] = [0.2, 0.1, 0.3, 0.05]
+        self.assertEqual(select_minima(scores, 3, 8), [97, 12, 50])
+        selected = select_minima(scores, 10, 8)
+        self.assertEqual(selected[:3], [97, 12, 50])
+        self.assertTrue(all(abs(a - b) > 8 for a in selected for b in selected if a != b))
+        self.assertEqual(select_minima(scores[:5], 2, 8), [0])
+
+    def test_interpolate_minimum_finds_parabola_vertex(self):
+        positions = np.arange(10, dtype=np.float64)
+        scores = 0.01 * (positions - 4.3) ** 2
+        self.assertAlmostEqual(interpolate_minimum(scores, 4), 4.3)
+        self.assertEqual(interpolate_minimum(scores, 0), 0)
+        scores[5] = 1
+        self.assertEqual(interpolate_minimum(scores, 4), 4)
+
+    def test_merge_ranges(self):
+        self.assertEqual(merge_ranges([(10, 20), (0, 5), (6, 8), (15, 30), (40, 39)]), [(0, 8), (10, 30)])
+
+
+class ScoreCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.curve = np.random.RandomState(0).rand(1000).astype(np.float32)
+        self.computed = []
+
+    def compute(self, first, last):
+        self.computed.append((first, last))
+        return self.curve[first:last + 1].copy()
+
+    def get(self, cache, first, last, key='pattern'):
+        result = cache.get(key, first, last, self.compute)
+        self.assertTrue(np.array_equal(result, self.curve[first:last + 1]))
+
+    def test_computes_only_missing_positions(self):
+        cache = ScoreCache(1 << 20)
+        self.get(cache, 100, 200)
+        self.get(cache, 300, 400)
+        self.get(cache, 150, 180)
+        self.get(cache, 50, 450)
+        self.get(cache, 0, 999)
+        self.get(cache, 120, 420)
+        self.assertEqual(self.computed, [(100, 200), (300, 400), (50, 99), (201, 299), (401, 450),
+                                         (0, 49), (451, 999)])
+
+    def test_keeps_patterns_separate(self):
+        cache = ScoreCache(1 << 20)
+        self.get(cache, 100, 200, key='a')
+        self.get(cache, 100, 200, key='b')
+        self.assertEqual(len(self.computed), 2)
+
+    def test_drops_least_recently_used_patterns(self):
+        cache = ScoreCache(self.curve[:300].nbytes)
+        self.get(cache, 0, 99, key='a')
+        self.get(cache, 0, 99, key='b')
+        self.get(cache, 0, 99, key='a')
+        self.get(cache, 0, 199, key='c')
+        self.get(cache, 0, 99, key='a')
+        self.get(cache, 0, 99, key='b')
+        self.assertEqual(self.computed, [(0, 99), (0, 99), (0, 199), (0, 99)])
+
+    def test_key_depends_on_content_and_type(self):
+        pattern = np.arange(100, dtype=np.uint8).reshape((1, -1))
+        self.assertEqual(ScoreCache.make_key(pattern), ScoreCache.make_key(pattern.copy()))
+        self.assertNotEqual(ScoreCache.make_key(pattern), ScoreCache.make_key(pattern[:, 1:]))
+        self.assertNotEqual(ScoreCache.make_key(pattern), ScoreCache.make_key(pattern.astype(np.float32)))
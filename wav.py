@@ -1,58 +1,128 @@
 import logging
 import cv2
 import numpy as np
-from chunk import Chunk
 import struct
 import math
 from time import time
-import os.path
+import os
+import glob
+import json
+import hashlib
+import mmap
+import tempfile
+import collections
+import bisect
+import threading
+import Queue
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from common import SushiError, clip
+from matching import match_template, correlate, decimate, get_energy, get_square_sums, normalize_sqdiff, \
+    select_candidates, select_minima, interpolate_minimum, merge_ranges, ScoreCache
 
 WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
 WAVE_FORMAT_EXTENSIBLE = 0xFFFE
 
+# Sony Wave64 chunk ids are GUIDs, all but riff sharing the same tail after the fourcc
+W64_GUID_TAIL = '\xf3\xac\xd3\x11\x8c\xd1\x00\xc0\x4f\x8e\xdb\x8a'
+W64_RIFF_GUID = 'riff\x2e\x91\xcf\x11\xa5\xd6\x28\xdb\x04\xc1\x00\x00'
+W64_WAVE_GUID = 'wave' + W64_GUID_TAIL
+W64_FMT_GUID = 'fmt ' + W64_GUID_TAIL
+W64_DATA_GUID = 'data' + W64_GUID_TAIL
+
 
 class DownmixedWavFile(object):
+    """
+    Memory-maps the data chunk of a WAV file and decodes it in large vectorized blocks, downmixing to mono float32.
+    Supports RIFF, RF64 and Wave64 containers with 8/16/24/32-bit integer or 32/64-bit float samples.
+    Samples are always scaled to the 16-bit range.
+    """
     _file = None
+    seekable = True
 
     def __init__(self, path):
         super(DownmixedWavFile, self).__init__()
         self._file = open(path, 'rb')
         try:
-            riff = Chunk(self._file, bigendian=False)
-            if riff.getname() != 'RIFF':
-                raise SushiError('File does not start with RIFF id')
-            if riff.read(4) != 'WAVE':
-                raise SushiError('Not a WAVE file')
-
-            fmt_chunk_read = False
-            data_chink_read = False
+            self._fmt_chunk_read = False
             file_size = os.path.getsize(path)
-
-            while True:
-                try:
-                    chunk = Chunk(self._file, bigendian=False)
-                except EOFError:
-                    break
-
-                if chunk.getname() == 'fmt ':
-                    self._read_fmt_chunk(chunk)
-                    fmt_chunk_read = True
-                elif chunk.getname() == 'data':
-                    if file_size > 0xFFFFFFFF:
-                        # large broken wav
-                        self.frames_count = (file_size - self._file.tell()) // self.frame_size
-                    else:
-                        self.frames_count = chunk.chunksize // self.frame_size
-                    data_chink_read = True
-                    break
-                chunk.skip()
-            if not fmt_chunk_read or not data_chink_read:
-                raise SushiError('Invalid WAV file')
+            magic = self._file.read(16)
+            self._file.seek(0)
+            if magic[:4] in ('RIFF', 'RF64'):
+                self._read_riff(file_size)
+            elif magic == W64_RIFF_GUID:
+                self._read_w64(file_size)
+            else:
+                raise SushiError('File does not start with RIFF id')
+            self._position = 0
         except:
             self.close()
             raise
 
+    def _read_riff(self, file_size):
+        riff_id, _, wave_id = struct.unpack('<4sL4s', self._file.read(12))
+        if wave_id != 'WAVE':
+            raise SushiError('Not a WAVE file')
+        ds64_data_size = None
+
+        while True:
+            header = self._file.read(8)
+            if len(header) < 8:
+                break
+            chunk_id, chunk_size = struct.unpack('<4sL', header)
+            chunk_start = self._file.tell()
+
+            if chunk_id == 'ds64':
+                _, ds64_data_size = struct.unpack('<QQ', self._file.read(16))
+            elif chunk_id == 'fmt ':
+                self._read_fmt_chunk(self._file.read(chunk_size))
+            elif chunk_id == 'data':
+                if riff_id == 'RF64' and ds64_data_size is not None:
+                    data_size = ds64_data_size
+                elif file_size > 0xFFFFFFFF:
+                    # large broken wav
+                    data_size = file_size - chunk_start
+                else:
+                    data_size = chunk_size
+                self._set_data_chunk(chunk_start, data_size, file_size)
+                return
+            # chunks are word-aligned
+            self._file.seek(chunk_start + chunk_size + (chunk_size & 1))
+        raise SushiError('Invalid WAV file')
+
+    def _read_w64(self, file_size):
+        if self._file.read(40)[24:] != W64_WAVE_GUID:
+            raise SushiError('Not a WAVE file')
+
+        while True:
+            header = self._file.read(24)
+            if len(header) < 24:
+                break
+            chunk_id, chunk_size = header[:16], struct.unpack('<Q', header[16:])[0]
+            chunk_start = self._file.tell()
+            # sizes include the 24-byte chunk header
+            body_size = chunk_size - 24
+            if body_size < 0:
+                break
+
+            if chunk_id == W64_FMT_GUID:
+                self._read_fmt_chunk(self._file.read(body_size))
+            elif chunk_id == W64_DATA_GUID:
+                self._set_data_chunk(chunk_start, body_size, file_size)
+                return
+            # chunks are aligned to 8 bytes
+            self._file.seek(chunk_start + body_size + (-chunk_size & 7))
+        raise SushiError('Invalid WAV file')
+
+    def _set_data_chunk(self, offset, data_size, file_size):
+        if not self._fmt_chunk_read:
+            raise SushiError('Invalid WAV file')
+        self._data_offset = offset
+        # truncated files might have data chunk size larger than the file itself
+        data_size = min(data_size, file_size - offset)
+        self.frames_count = data_size // self.frame_size
+
     def __del__(self):
         self.close()
 
@@ -61,128 +131,1385 @@ class DownmixedWavFile(object):
             self._file.close()
             self._file = None
 
+    def setpos(self, position):
+        self._position = position
+
     def readframes(self, count):
-        if not count:
-            return ''
-        data = self._file.read(count * self.frame_size)
-        if self.sample_width == 2:
-            unpacked = np.fromstring(data, dtype=np.int16)
+        count = min(count, self.frames_count - self._position)
+        if count <= 0:
+            return np.empty(0, np.float32)
+        raw = np.memmap(self._file, dtype=np.uint8, mode='r', shape=(count * self.frame_size,),
+                        offset=self._data_offset + self._position * self.frame_size)
+        self._position += count
+        return self._downmix(self._decode(raw))
+
+    def _decode(self, raw):
+        if self.sample_format == WAVE_FORMAT_IEEE_FLOAT:
+            return raw.view('<f4' if self.sample_width == 4 else '<f8'), 32768.0
+        elif self.sample_width == 1:
+            # 8-bit pcm is unsigned
+            return raw.view(np.int8) ^ np.int8(-128), 256.0
+        elif self.sample_width == 2:
+            return raw.view('<i2'), 1.0
         elif self.sample_width == 3:
-            raw_bytes = np.ndarray(len(data), 'int8', data)
-            unpacked = np.zeros(len(data) / 3, np.int16)
-            unpacked.view(dtype='int8')[0::2] = raw_bytes[1::3]
-            unpacked.view(dtype='int8')[1::2] = raw_bytes[2::3]
+            # putting 24-bit samples into the upper bytes of int32 keeps the sign
+            widened = np.zeros((len(raw) // 3, 4), np.uint8)
+            widened[:, 1:] = raw.reshape((-1, 3))
+            return widened.view('<i4')[:, 0], 1.0 / 65536
         else:
-            raise SushiError('Unsupported sample width: {0}'.format(self.sample_width))
+            return raw.view('<i4'), 1.0 / 65536
 
-        unpacked = unpacked.astype('float32')
+    def _downmix(self, decoded):
+        samples, scale = decoded
+        channels = samples.reshape((-1, self.channels_count))
+        # accumulating one channel at a time is faster than numpy reductions over the short last axis
+        data = channels[:, 0].astype(np.float32)
+        for idx in xrange(1, self.channels_count):
+            data += channels[:, idx]
+        scale /= self.channels_count
+        if scale != 1:
+            data *= scale
+        return data
 
-        if self.channels_count == 1:
-            return unpacked
-        else:
-            min_length = len(unpacked) // self.channels_count
-            real_length = len(unpacked) / float(self.channels_count)
-            if min_length != real_length:
-                logging.error("Length of audio channels didn't match. This might result in broken output")
-
-            channels = (unpacked[i::self.channels_count] for i in xrange(self.channels_count))
-            data = reduce(lambda a, b: a[:min_length]+b[:min_length], channels)
-            data /= float(self.channels_count)
-            return data
-
-    def _read_fmt_chunk(self, chunk):
-        wFormatTag, self.channels_count, self.framerate, dwAvgBytesPerSec, wBlockAlign = struct.unpack('<HHLLH',
-                                                                                                       chunk.read(14))
-        if wFormatTag == WAVE_FORMAT_PCM or wFormatTag == WAVE_FORMAT_EXTENSIBLE:  # ignore the rest
-            bits_per_sample = struct.unpack('<H', chunk.read(2))[0]
-            self.sample_width = (bits_per_sample + 7) // 8
+    def _read_fmt_chunk(self, data):
+        if len(data) < 16:
+            raise SushiError('Invalid WAV file')
+        format_tag, self.channels_count, self.framerate, _, _, bits_per_sample = struct.unpack('<HHLLHH', data[:16])
+        if format_tag == WAVE_FORMAT_EXTENSIBLE and len(data) >= 26:
+            # the first two bytes of the SubFormat GUID are the actual format tag
+            format_tag = struct.unpack('<H', data[24:26])[0]
+        self.sample_width = (bits_per_sample + 7) // 8
+
+        if format_tag == WAVE_FORMAT_PCM:
+            if self.sample_width not in (1, 2, 3, 4):
+                raise SushiError('Unsupported sample width: {0}'.format(self.sample_width))
+        elif format_tag == WAVE_FORMAT_IEEE_FLOAT:
+            if self.sample_width not in (4, 8):
+                raise SushiError('Unsupported sample width: {0}'.format(self.sample_width))
         else:
-            raise SushiError('unknown format: {0}'.format(wFormatTag))
+            raise SushiError('unknown format: {0}'.format(format_tag))
+        if not self.channels_count:
+            raise SushiError('Invalid WAV file')
+        self.sample_format = format_tag
         self.frame_size = self.channels_count * self.sample_width
+        self._fmt_chunk_read = True
+
+
+class RawPcmPipe(object):
+    """
+    Reads mono pcm_s16le audio from the stdout of a running process (ffmpeg).
+    Total length of the stream is unknown until the process is done, so frames_count is always None.
+    """
+    sample_width = 2
+    channels_count = 1
+    frame_size = 2
+    frames_count = None
+    seekable = False
+
+    def __init__(self, process, framerate, name='pipe'):
+        super(RawPcmPipe, self).__init__()
+        self._process = process
+        self.framerate = framerate
+        self.name = name
+
+    def readframes(self, count):
+        data = self._process.stdout.read(count * self.frame_size)
+        # ignore the incomplete frame at the end of the stream
+        data = data[:len(data) - len(data) % self.frame_size]
+        return np.fromstring(data, dtype=np.int16).astype('float32')
+
+    def close(self):
+        if self._process:
+            process, self._process = self._process, None
+            process.stdout.close()
+            if process.wait() != 0:
+                raise SushiError('ffmpeg failed to decode audio of {0}'.format(self.name))
+
+
+class Resampler(object):
+    """
+    Anti-aliased resampler processing a stream in consecutive blocks of any size.
+
+    Integer ratios (like 48000 -> 12000) are low-pass filtered and decimated exactly using polyphase filtering.
+    Other ratios filter the input and interpolate it at exact fractional positions. Output positions are always
+    computed from the absolute output index, so no timing error accumulates between blocks.
+    Resampling can start at any output index (first_output), the caller then has to feed input starting at
+    first_input. Anything outside of the input is considered silence.
+    """
+    ZERO_CROSSINGS = 10
+    ROLLOFF = 0.85
+    KAISER_BETA = 5.0
+
+    def __init__(self, src_rate, dst_rate, first_output=0):
+        super(Resampler, self).__init__()
+        self.src_rate = src_rate
+        self.dst_rate = dst_rate
+        self._decimation = src_rate // dst_rate if src_rate % dst_rate == 0 else None
+
+        step = src_rate / float(dst_rate)
+        if step > 1:
+            cutoff = 0.5 / step * self.ROLLOFF
+            self._half = int(math.ceil(self.ZERO_CROSSINGS * step))
+            points = np.arange(-self._half, self._half + 1)
+            kernel = np.sinc(2 * cutoff * points) * np.kaiser(len(points), self.KAISER_BETA)
+            self._kernel = (kernel / kernel.sum()).astype(np.float32)
+        else:
+            # upsampling doesn't need any filtering
+            self._half = 0
+            self._kernel = np.ones(1, np.float32)
+
+        self._next_output = first_output
+        buffer_start = self._input_position(first_output) - self._half
+        self.first_input = max(buffer_start, 0)
+        self._buffer_start = buffer_start
+        self._buffer = np.zeros(self.first_input - buffer_start, np.float32)
+
+    def _input_position(self, output_idx):
+        return output_idx * self.src_rate // self.dst_rate
+
+    def input_end(self, end_output):
+        """
+        Index of the input sample right after the last one needed to compute outputs up to end_output
+        """
+        return self._input_position(end_output - 1) + self._half + 2
+
+    def process(self, data):
+        """
+        Consumes the next block of input and returns all output samples that can be computed so far
+        """
+        self._buffer = np.concatenate((self._buffer, data)) if len(self._buffer) else data
+        # last input sample that has all of its filter taps available
+        last_input = self._buffer_start + len(self._buffer) - 1 - self._half
+        if self._decimation is None:
+            # interpolation needs the next filtered sample too
+            last_input -= 1
+        # first output index whose input position is past last_input
+        end_output = -(-(last_input + 1) * self.dst_rate // self.src_rate)
+        return self._produce(end_output)
+
+    def finish(self, total_outputs):
+        """
+        Pads the input with silence and returns output samples up to total_outputs
+        """
+        if total_outputs <= self._next_output:
+            return np.empty(0, np.float32)
+        missing = self.input_end(total_outputs) - (self._buffer_start + len(self._buffer))
+        if missing > 0:
+            self._buffer = np.concatenate((self._buffer, np.zeros(missing, np.float32)))
+        return self._produce(total_outputs)
+
+    def _produce(self, end_output):
+        start_output = self._next_output
+        if end_output <= start_output:
+            return np.empty(0, np.float32)
+
+        first = self._input_position(start_output)
+        last = self._input_position(end_output - 1)
+        if self._decimation is None:
+            last += 1
+        segment = self._buffer[first - self._half - self._buffer_start:last + self._half + 1 - self._buffer_start]
+
+        if self._decimation is not None:
+            result = self._decimate(segment, end_output - start_output)
+        else:
+            filtered = np.convolve(segment, self._kernel, 'valid')
+            positions = np.arange(start_output, end_output) * (self.src_rate / float(self.dst_rate)) - first
+            result = np.interp(positions, np.arange(len(filtered)), filtered).astype(np.float32)
+
+        self._next_output = end_output
+        # dropping the input we won't ever need again
+        new_start = self._input_position(end_output) - self._half
+        self._buffer = self._buffer[new_start - self._buffer_start:]
+        self._buffer_start = new_start
+        return result
+
+    def _decimate(self, segment, count):
+        # polyphase decomposition: only every n-th filtered sample is ever computed
+        factor = self._decimation
+        result = np.zeros(count, np.float32)
+        for phase in xrange(min(factor, len(self._kernel))):
+            # phase kernels are short, so opencv filters them directly (not through DFT) and much faster than numpy
+            data = np.ascontiguousarray(segment[phase::factor]).reshape((1, -1))
+            kernel = self._kernel[phase::factor].reshape((1, -1))
+            result += cv2.filter2D(data, -1, kernel, anchor=(0, 0), borderType=cv2.BORDER_CONSTANT)[0][:count]
+        return result
+
+
+class AmplitudeHistogram(object):
+    """
+    Collects histograms of positive and negative sample values (in the 16-bit range), so clipping values
+    can be computed from medians without keeping the whole stream in memory.
+    Precision of the medians is one 16-bit step.
+    """
+    SIZE = 1 << 16
+
+    def __init__(self):
+        super(AmplitudeHistogram, self).__init__()
+        self._positive = np.zeros(self.SIZE, np.int64)
+        self._negative = np.zeros(self.SIZE, np.int64)
+
+    def update(self, other):
+        """
+        Merges another histogram into this one, e.g. when parts of a stream are processed separately
+        """
+        self._positive += other._positive
+        self._negative += other._negative
+
+    def add(self, data):
+        magnitudes = np.minimum(np.abs(data) + 0.5, self.SIZE - 1).astype(np.int32)
+        self._positive += np.bincount(magnitudes[data >= 0], minlength=self.SIZE)
+        self._negative += np.bincount(magnitudes[data <= 0], minlength=self.SIZE)
+
+    @staticmethod
+    def _median(histogram):
+        cumulative = np.cumsum(histogram)
+        total = cumulative[-1]
+        if not total:
+            return 0.0
+        # average of two middle values, same as np.median
+        lower = np.searchsorted(cumulative, (total - 1) // 2, side='right')
+        upper = np.searchsorted(cumulative, total // 2, side='right')
+        return (lower + upper) / 2.0
+
+    def get_clip_values(self):
+        # clipping the stream by 3*median value from both sides of zero
+        return -self._median(self._negative) * 3, self._median(self._positive) * 3
 
 
 class WavStream(object):
-    READ_CHUNK_SIZE = 1  # one second, seems to be the fastest
+    """
+    Normalized mono audio prepared for matching.
+    Samples are stored as one of SAMPLE_TYPES: linear uint8, float32, float16, mu-law companded uint8 or
+    mu-law companded 4-bit values packed two per byte. Float16 is matched as float32 and 4-bit values are
+    spread over the uint8 range, everything else is matched as is.
+    """
+    # seconds, keeps temporaries of the two-pass load well below the size of the output while per-call overhead
+    # is still negligible
+    READ_CHUNK_SIZE = 10
+    MIN_CHUNK_SECONDS = 1
     PADDING_SECONDS = 10
+    SAMPLE_TYPES = ('uint8', 'float32', 'float16', 'mulaw', 'uint4')
+    MU = 255.0
+    INDEX_BLOCK_SIZE = 1 << 20
+    # decimation factors of the coarse levels used by build_pyramid, about 750 Hz and 3 kHz at 12 kHz
+    PYRAMID_FACTORS = (16, 4)
+    PYRAMID_CANDIDATES = 5
+    # levels where the decimated pattern would be shorter than this are skipped
+    PYRAMID_MIN_PATTERN = 32
+    # one of matching.BACKENDS or 'auto'
+    matcher = 'auto'
+    # whether match times are interpolated between samples, see matching.interpolate_minimum
+    interpolate = False
+    # prefix sums of squared samples, see build_energy_index
+    energy = None
+    # list of (factor, decimated samples), see build_pyramid
+    pyramid = None
+    # seconds between matches returned by find_substream_candidates
+    CANDIDATE_SEPARATION = 0.5
+    # matching.ScoreCache, see enable_search_cache
+    search_cache = None
+    SEARCH_CACHE_SIZE = 256 * 1024 * 1024
 
-    def __init__(self, path, sample_rate=12000, sample_type='uint8'):
-        if sample_type not in ('float32', 'uint8'):
-            raise SushiError('Unknown sample type of WAV stream, must be uint8 or float32')
+    def __init__(self, path, sample_rate=12000, sample_type='uint8', workers=None):
+        """
+        path can also be an already opened reader like RawPcmPipe, in which case audio is read from it directly.
+        WAV files given by path are decoded by up to workers threads (all cores by default), each one
+        handling its own part of the output.
+        """
+        if sample_type not in self.SAMPLE_TYPES:
+            raise SushiError('Unknown sample type of WAV stream, must be one of: {0}'
+                             .format(', '.join(self.SAMPLE_TYPES)))
 
-        stream = DownmixedWavFile(path)
-        total_seconds = stream.frames_count / float(stream.framerate)
-        downsample_rate = sample_rate / float(stream.framerate)
+        if isinstance(path, basestring):
+            stream = DownmixedWavFile(path)
+            can_reopen = True
+        else:
+            stream, path = path, path.name
+            can_reopen = False
 
-        self.sample_count = math.ceil(total_seconds * sample_rate)
         self.sample_rate = sample_rate
-        # pre-allocating the data array and some place for padding
-        self.data = np.empty((1, int(self.PADDING_SECONDS * 2 * stream.framerate + self.sample_count)), np.float32)
-        self.padding_size = 10 * stream.framerate
+        self.sample_type = sample_type
+        self.padding_size = self.PADDING_SECONDS * sample_rate
+        readers = [stream]
         before_read = time()
         try:
-            seconds_read = 0
-            samples_read = self.padding_size
-            while seconds_read < total_seconds:
-                data = stream.readframes(int(self.READ_CHUNK_SIZE * stream.framerate))
-                new_length = int(round(len(data) * downsample_rate))
+            if stream.seekable:
+                self.sample_count = self._get_output_length(stream.frames_count, stream.framerate)
+                ranges = self._split_output(workers if can_reopen else 1)
+                # every worker needs its own reader
+                readers.extend(DownmixedWavFile(path) for _ in ranges[1:])
+                jobs = [(reader, start, end) for reader, (start, end) in zip(readers, ranges)]
+                # workers share READ_CHUNK_SIZE, so memory of blocks being decoded doesn't grow with their count
+                # until each one is down to MIN_CHUNK_SECONDS, reading less at once would mostly pay per-call overhead
+                chunk_size = max(self.READ_CHUNK_SIZE / float(len(jobs)), self.MIN_CHUNK_SECONDS)
+                collect_histogram = lambda reader, start, end: self._collect_histogram(reader, start, end, chunk_size)
 
-                dst_view = self.data[0][samples_read:samples_read+new_length]
+                # first pass only collects statistics, the audio is decoded again when writing the output
+                histogram = AmplitudeHistogram()
+                for range_histogram in self._run_jobs(collect_histogram, jobs):
+                    histogram.update(range_histogram)
+                min_value, max_value = histogram.get_clip_values()
 
-                if downsample_rate != 1:
-                    data = data.reshape((1, len(data)))
-                    data = cv2.resize(data, (new_length, 1), interpolation=cv2.INTER_NEAREST)[0]
+                self._allocate()
+                self._run_jobs(lambda reader, start, end: self._write_chunks(
+                    self._read_range(reader, start, end, chunk_size), start, min_value, max_value), jobs)
+            else:
+                # pipes can't be read twice, keeping the audio around with 16-bit precision
+                histogram = AmplitudeHistogram()
+                chunks = []
+                for chunk in self._read_chunks(stream):
+                    histogram.add(chunk)
+                    chunks.append(np.clip(np.rint(chunk), -32768, 32767).astype(np.int16))
+                self.sample_count = sum(len(c) for c in chunks)
+                min_value, max_value = histogram.get_clip_values()
 
-                np.copyto(dst_view, data, casting='no')
-                samples_read += new_length
-                seconds_read += self.READ_CHUNK_SIZE
+                self._allocate()
+                self._write_chunks(self._drain(chunks), 0, min_value, max_value)
 
             # padding the audio from both sides
-            self.data[0][0:self.padding_size].fill(self.data[0][self.padding_size])
-            self.data[0][-self.padding_size:].fill(self.data[0][-self.padding_size-1])
-
-            # normalizing
-            # also clipping the stream by 3*median value from both sides of zero
-            max_value = np.median(self.data[self.data >= 0], overwrite_input=True) * 3
-            min_value = np.median(self.data[self.data <= 0], overwrite_input=True) * 3
-
-            np.clip(self.data, min_value, max_value, out=self.data)
-
-            self.data -= min_value
-            self.data /= (max_value - min_value)
-
-            if sample_type == 'uint8':
-                self.data *= 255.0
-                self.data += 0.5
-                self.data = self.data.astype('uint8')
+            audio_end = self.padding_size + self.sample_count
+            self._store(0, np.repeat(self._get_stored_sample(self.padding_size), self.padding_size))
+            self._store(audio_end, np.repeat(self._get_stored_sample(audio_end - 1), self.padding_size))
 
         except Exception as e:
             raise SushiError('Error while loading {0}: {1}'.format(path, e))
         finally:
-            stream.close()
+            for reader in readers:
+                reader.close()
         logging.info('Done reading WAV {0} in {1}s'.format(path, time() - before_read))
 
+    def _split_output(self, workers):
+        # parts shorter than a single read chunk aren't worth a separate thread
+        max_parts = max(self.sample_count // (self.READ_CHUNK_SIZE * self.sample_rate), 1)
+        parts = clip(workers or multiprocessing.cpu_count(), 1, max_parts)
+        # even bounds keep packed 4-bit samples of different parts in separate bytes
+        bounds = [self.sample_count * idx // parts // 2 * 2 for idx in xrange(parts)] + [self.sample_count]
+        return zip(bounds[:-1], bounds[1:])
+
+    @staticmethod
+    def _run_jobs(function, jobs):
+        if len(jobs) == 1:
+            return [function(*jobs[0])]
+        pool = ThreadPool(len(jobs))
+        try:
+            return pool.map(lambda job: function(*job), jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _collect_histogram(self, reader, start, end, chunk_size=None):
+        histogram = AmplitudeHistogram()
+        for chunk in self._read_range(reader, start, end, chunk_size):
+            histogram.add(chunk)
+        return histogram
+
+    def _get_storage_shape(self):
+        length = self.padding_size * 2 + self.sample_count
+        return 1, (length + 1) // 2 if self.sample_type == 'uint4' else length
+
+    def _allocate(self):
+        # pre-allocating the data array and some place for padding
+        # packed samples are or-ed into their bytes, so those have to start from zero
+        allocate = np.zeros if self.sample_type == 'uint4' else np.empty
+        self.data = allocate(self._get_storage_shape(), self._get_dtype(self.sample_type))
+
+    def _write_chunks(self, chunks, start, min_value, max_value):
+        position = self.padding_size + start
+        for chunk in chunks:
+            normalized = self._normalize(np.asarray(chunk, np.float32), min_value, max_value, self.sample_type)
+            self._store(position, normalized)
+            position += len(normalized)
+
+    def _store(self, position, samples):
+        if self.sample_type != 'uint4':
+            self.data[0, position:position+len(samples)] = samples
+            return
+        # the first sample of every pair goes into the lower half of the byte
+        if len(samples) and position & 1:
+            self.data[0, position // 2] |= samples[0] << 4
+            samples = samples[1:]
+            position += 1
+        offset = position // 2
+        pairs = len(samples) // 2
+        self.data[0, offset:offset+pairs] = samples[0:pairs*2:2] | (samples[1:pairs*2:2] << 4)
+        if len(samples) & 1:
+            self.data[0, offset + pairs] |= samples[-1]
+
+    def _get_stored_sample(self, position):
+        if self.sample_type == 'uint4':
+            return (self.data[0, position // 2] >> (4 * (position & 1))) & 0x0F
+        return self.data[0, position]
+
+    @staticmethod
+    def _drain(chunks):
+        # releasing every chunk right after it's written to the output
+        chunks.reverse()
+        while chunks:
+            yield chunks.pop()
+
+    @staticmethod
+    def _get_dtype(sample_type):
+        if sample_type == 'float32':
+            return np.float32
+        elif sample_type == 'float16':
+            return np.float16
+        return np.uint8
+
+    @classmethod
+    def _normalize(cls, data, min_value, max_value, sample_type):
+        """
+        Scales float32 data (in-place) to the 0-1 range and encodes it as sample_type, one value per sample
+        """
+        np.clip(data, min_value, max_value, out=data)
+
+        data -= min_value
+        data /= (max_value - min_value)
+
+        if sample_type == 'uint8':
+            return cls._quantize(data, 255)
+        elif sample_type in ('mulaw', 'uint4'):
+            # companding gives quiet parts of the audio (like dialogue) more levels than loud ones
+            data *= 2
+            data -= 1
+            sign = np.sign(data)
+            np.abs(data, out=data)
+            data *= cls.MU
+            np.log1p(data, out=data)
+            data *= sign
+            data /= math.log1p(cls.MU)
+            data += 1
+            data /= 2
+            return cls._quantize(data, 255 if sample_type == 'mulaw' else 15)
+        elif sample_type == 'float16':
+            return data.astype(np.float16)
+        return data
+
+    @staticmethod
+    def _quantize(data, levels):
+        data *= levels
+        data += 0.5
+        return data.astype(np.uint8)
+
+    @staticmethod
+    def _expand(samples, sample_type):
+        # opencv can only match uint8 and float32 data
+        if sample_type == 'float16':
+            return samples.astype(np.float32)
+        elif sample_type == 'uint4':
+            return samples * np.uint8(17)
+        return samples
+
+    @classmethod
+    def from_array(cls, data, sample_rate, sample_count, sample_type):
+        """
+        Creates a stream from already normalized and padded data, for example loaded from WavStreamCache
+        """
+        stream = cls.__new__(cls)
+        stream.data = data
+        stream.sample_rate = sample_rate
+        stream.sample_count = sample_count
+        stream.sample_type = sample_type
+        stream.padding_size = cls.PADDING_SECONDS * sample_rate
+        return stream
+
+    def _get_output_length(self, frames_count, framerate):
+        return -(-frames_count * self.sample_rate // framerate)
+
+    def _read_chunks(self, stream):
+        resampler = Resampler(stream.framerate, self.sample_rate) if stream.framerate != self.sample_rate else None
+        frames_read = 0
+        while True:
+            data = stream.readframes(int(self.READ_CHUNK_SIZE * stream.framerate))
+            if not len(data):
+                break
+            frames_read += len(data)
+            yield resampler.process(data) if resampler else data
+        if resampler:
+            yield resampler.finish(self._get_output_length(frames_read, stream.framerate))
+
+    def _read_range(self, reader, start, end, chunk_size=None):
+        """
+        Reads output samples between start and end from a seekable reader, in chunks of chunk_size seconds
+        (READ_CHUNK_SIZE by default)
+        """
+        chunk_frames = max(int((chunk_size or self.READ_CHUNK_SIZE) * reader.framerate), 1)
+        if reader.framerate == self.sample_rate:
+            resampler = None
+            input_start, input_end = start, end
+        else:
+            resampler = Resampler(reader.framerate, self.sample_rate, first_output=start)
+            input_start, input_end = resampler.first_input, resampler.input_end(end)
+
+        reader.setpos(input_start)
+        position = input_start
+        remaining = end - start
+        while position < input_end and remaining > 0:
+            data = reader.readframes(min(chunk_frames, input_end - position))
+            if not len(data):
+                break
+            position += len(data)
+            chunk = resampler.process(data)[:remaining] if resampler else data[:remaining]
+            remaining -= len(chunk)
+            yield chunk
+        if resampler and remaining > 0:
+            yield resampler.finish(end)
+
     @property
     def duration_seconds(self):
-        return self.sample_count / self.sample_rate
+        return self.sample_count / float(self.sample_rate)
 
     def get_substream(self, start, end):
         start_off = self._get_sample_for_time(start)
         end_off = self._get_sample_for_time(end)
-        return self.data[:, start_off:end_off]
+        return self._get_samples(start_off, end_off)
+
+    def _get_samples(self, start, end):
+        # start and end are REAL samples, including padding
+        if self.sample_type == 'uint4':
+            packed = self._get_stored(start // 2, (end + 1) // 2)
+            codes = np.empty((1, packed.shape[1] * 2), np.uint8)
+            codes[:, 0::2] = packed & 0x0F
+            codes[:, 1::2] = packed >> 4
+            return self._expand(codes[:, start & 1:(start & 1) + end - start], self.sample_type)
+        return self._expand(self._get_stored(start, end), self.sample_type)
+
+    def _get_stored(self, start, end):
+        return self.data[:, start:end]
+
+    def prefetch(self, start, end):
+        """
+        Hints that the stream between start and end will be needed soon. Everything is in memory already.
+        """
+        pass
+
+    def close(self):
+        pass
+
+    def build_energy_index(self):
+        """
+        Precomputes prefix sums of squared samples of the whole stream, so searches only have to correlate
+        the pattern with the window. Takes 8 bytes per sample.
+        """
+        total = self.sample_count + 2 * self.padding_size
+        energy = np.empty(total + 1, np.float64)
+        energy[0] = 0
+        for start in xrange(0, total, self.INDEX_BLOCK_SIZE):
+            end = min(start + self.INDEX_BLOCK_SIZE, total)
+            energy[start + 1:end + 1] = get_square_sums(self._get_samples(start, end)[0])[1:] + energy[start]
+        self.energy = energy
+
+    def build_pyramid(self, factors=None):
+        """
+        Precomputes decimated copies of the stream, each sample being an average of factor samples.
+        find_substream then locates a few candidates over the whole window at the coarsest level
+        and only refines around them at the finer ones.
+        """
+        pyramid = []
+        for factor in sorted(factors or self.PYRAMID_FACTORS, reverse=True):
+            size = (self.sample_count + 2 * self.padding_size) // factor
+            level = np.empty((1, size), np.float32)
+            block_size = max(self.INDEX_BLOCK_SIZE // factor, 1) * factor
+            for start in xrange(0, size * factor, block_size):
+                end = min(start + block_size, size * factor)
+                level[:, start // factor:end // factor] = decimate(self._get_samples(start, end), factor)
+            pyramid.append((factor, level))
+        self.pyramid = pyramid
+
+    def enable_search_cache(self, max_bytes=None):
+        """
+        Remembers scores of all exhaustive searches, so searching for the same pattern in an already searched region
+        again (like when calculate_shifts rewinds) only scans the part of the window that wasn't scanned yet.
+        """
+        self.search_cache = ScoreCache(max_bytes or self.SEARCH_CACHE_SIZE)
+
+    def get_envelope(self, rate):
+        """
+        Loudness of the stream without padding as standard deviation of every sample_rate / rate samples
+        """
+        factor = max(self.sample_rate // rate, 1)
+        size = self.sample_count // factor
+        envelope = np.empty(size, np.float32)
+        block_size = max(self.INDEX_BLOCK_SIZE // factor, 1) * factor
+        for start in xrange(0, size * factor, block_size):
+            end = min(start + block_size, size * factor)
+            samples = self._get_samples(self.padding_size + start, self.padding_size + end)
+            envelope[start // factor:end // factor] = samples.reshape((-1, factor)).std(axis=1, dtype=np.float32)
+        return envelope
+
+    def get_loudness(self, start, end):
+        """
+        Standard deviation of samples between start and end seconds as a fraction of the full range of samples,
+        companded samples are expanded to linear values first
+        """
+        samples = self.get_substream(start, end)
+        if self.sample_type in ('mulaw', 'uint4'):
+            samples = self._linearize(samples)
+        full_range = 255.0 if samples.dtype == np.uint8 else 1.0
+        return samples.std(dtype=np.float64) / full_range
+
+    @classmethod
+    def _linearize(cls, samples):
+        # inverse of the companding done by _normalize, codes of both sample types are expanded to 0-255
+        data = samples.astype(np.float64) / 127.5 - 1
+        sign = np.sign(data)
+        np.abs(data, out=data)
+        data *= math.log1p(cls.MU)
+        np.expm1(data, out=data)
+        data *= sign
+        data /= cls.MU
+        data += 1
+        data /= 2
+        return data
+
+    def _get_square_sums(self, samples, start):
+        # prefix sums of squared samples read from start, only differences between them are meaningful
+        if self.energy is None:
+            return get_square_sums(samples[0])
+        return self.energy[start:start + samples.shape[1] + 1]
 
     def _get_sample_for_time(self, timestamp):
         # this function gets REAL sample for time, taking padding into account
         return int(self.sample_rate * timestamp) + self.padding_size
 
-    def find_substream(self, pattern, window_center, window_size):
+    def _get_search_range(self, pattern_size, window_center, window_size):
         start_time = clip(window_center - window_size, -self.PADDING_SECONDS, self.duration_seconds)
         end_time = clip(window_center + window_size, 0, self.duration_seconds + self.PADDING_SECONDS)
+        return start_time, self._get_sample_for_time(start_time), self._get_sample_for_time(end_time) + pattern_size
+
+    def _match(self, pattern, start_sample, end_sample):
+        search_source = self._get_samples(start_sample, end_sample)
+        if self.energy is None:
+            return match_template(search_source, pattern, self.matcher)
+        pattern_size = len(pattern[0])
+        squares = self._get_square_sums(search_source, start_sample)
+        return normalize_sqdiff(correlate(search_source, pattern, self.matcher),
+                                squares[pattern_size:] - squares[:-pattern_size], get_energy(pattern))
+
+    def find_substream(self, pattern, window_center, window_size):
+        if self._use_pyramid(len(pattern[0]), window_size):
+            return self._find_substream_coarse_to_fine(pattern, window_center, window_size)
+        start_time, start_sample, end_sample = self._get_search_range(len(pattern[0]), window_center, window_size)
+
+        scores = self._get_scores(pattern, start_sample, end_sample)
+        min_idx = scores.argmin()
+
+        return scores[min_idx], self._get_match_time(start_time, scores, min_idx)
+
+    def _get_match_time(self, start_time, scores, idx):
+        if self.interpolate:
+            idx = interpolate_minimum(scores, idx)
+        return start_time + (idx / float(self.sample_rate))
+
+    def _use_pyramid(self, pattern_size, window_size):
+        # refining every candidate costs about as much as a search over a pattern-sized window
+        return self.pyramid is not None and 2 * window_size * self.sample_rate > (self.PYRAMID_CANDIDATES + 1) * pattern_size
+
+    def _get_scores(self, pattern, start_sample, end_sample, compute=None):
+        """
+        Scores of all positions of the pattern between start_sample and end_sample, compute(first, last) gives
+        scores of positions from first to last inclusive and is only called for those missing in the search cache
+        """
+        pattern_size = len(pattern[0])
+        if compute is None:
+            compute = lambda first, last: self._match(pattern, first, last + pattern_size)[0]
+        # positions past the end of the stream can't be matched completely
+        last = min(end_sample, self.sample_count + 2 * self.padding_size) - pattern_size
+        if self.search_cache is None:
+            return compute(start_sample, last)
+        return self.search_cache.get(ScoreCache.make_key(pattern), start_sample, last, compute)
+
+    def _find_substream_coarse_to_fine(self, pattern, window_center, window_size):
+        pattern_size = len(pattern[0])
+        start_time, start_sample, end_sample = self._get_search_range(pattern_size, window_center, window_size)
+        last_position = min(end_sample, self.sample_count + 2 * self.padding_size) - pattern_size
+        # inclusive ranges of pattern positions that are still worth checking
+        ranges = [(start_sample, last_position)]
+
+        for factor, level in self.pyramid:
+            coarse_pattern = decimate(pattern, factor)
+            if len(coarse_pattern[0]) < self.PYRAMID_MIN_PATTERN:
+                continue
+            scores, positions = [], []
+            for first, last in ranges:
+                source = level[:, first // factor:last // factor + len(coarse_pattern[0])]
+                if len(source[0]) < len(coarse_pattern[0]):
+                    continue
+                result = match_template(source, coarse_pattern, self.matcher)[0]
+                scores.append(result)
+                positions.append((np.arange(len(result)) + first // factor) * factor)
+            if not scores:
+                continue
+            # coarse positions are off by up to a factor because of the decimation grid
+            radius = 2 * factor
+            candidates = select_candidates(np.concatenate(scores), np.concatenate(positions),
+                                           self.PYRAMID_CANDIDATES, radius)
+            ranges = merge_ranges((max(p - radius, start_sample), min(p + radius, last_position)) for p in candidates)
+
+        best = None
+        for first, last in ranges:
+            result = self._match(pattern, first, last + pattern_size)
+            min_idx = result.argmin(axis=1)[0]
+            if best is None or result[0][min_idx] < best[0]:
+                best = result[0][min_idx], self._get_match_time(start_time, result[0], min_idx) + \
+                    (first - start_sample) / float(self.sample_rate)
+
+        return best
+
+    def find_substream_candidates(self, pattern, window_center, window_size, count):
+        """
+        Up to count best matches of the pattern as (diff, time) found in a single scan, best first.
+        Every one is further than CANDIDATE_SEPARATION seconds from all better ones.
+        """
+        start_time, start_sample, end_sample = self._get_search_range(len(pattern[0]), window_center, window_size)
+        scores = self._get_scores(pattern, start_sample, end_sample)
+        return [(scores[idx], self._get_match_time(start_time, scores, idx))
+                for idx in select_minima(scores, count, self.CANDIDATE_SEPARATION * self.sample_rate)]
+
+    def find_substream_split(self, pattern, window_center, window_size):
+        """
+        Equivalent to searching for the pattern and for both of its halves with find_substream, the right half
+        around a center moved by the duration of the left one. All three score curves are built from two half
+        correlations over a single search source, since the full pattern correlation is their sum.
+        Returns (diff, time) of the full pattern and the times suggested by the left and the right half.
+        """
+        half_size = len(pattern[0]) // 2
+        right_offset = half_size / float(self.sample_rate)
 
-        start_sample = self._get_sample_for_time(start_time)
-        end_sample = self._get_sample_for_time(end_time) + len(pattern[0])
+        if self._use_pyramid(len(pattern[0]), window_size):
+            # coarse-to-fine searches are cheap enough on their own
+            return (self.find_substream(pattern, window_center, window_size),
+                    self.find_substream(pattern[:, :half_size], window_center, window_size)[1],
+                    self.find_substream(pattern[:, half_size:], window_center + right_offset, window_size)[1] -
+                    right_offset)
 
-        search_source = self.data[:, start_sample:end_sample]
-        result = cv2.matchTemplate(search_source, pattern, cv2.TM_SQDIFF_NORMED)
-        min_idx = result.argmin(axis=1)[0]
+        (full_time, full), (left_time, left), (right_time, right) = self._get_split_scores(
+            pattern, window_center, window_size)
+        min_idx = full.argmin()
+        return ((full[min_idx], self._get_match_time(full_time, full, min_idx)),
+                self._get_match_time(left_time, left, left.argmin()),
+                self._get_match_time(right_time, right, right.argmin()))
 
-        return result[0][min_idx], start_time + (min_idx / float(self.sample_rate))
+    def find_substream_split_candidates(self, pattern, window_center, window_size, count):
+        """
+        Up to count results like the one of find_substream_split from a single scan, for the best matches
+        of the pattern separated like in find_substream_candidates. The first one is the same find_substream_split
+        returns, half times of the other ones are the best within CANDIDATE_SEPARATION of their match.
+        Coarse-to-fine searches only give the best match.
+        """
+        if self._use_pyramid(len(pattern[0]), window_size):
+            return [self.find_substream_split(pattern, window_center, window_size)]
+
+        (full_time, full), (left_time, left), (right_time, right) = self._get_split_scores(
+            pattern, window_center, window_size)
+        separation = int(self.CANDIDATE_SEPARATION * self.sample_rate)
+
+        def get_half_time(start_time, scores, idx):
+            # idx is the position of the full pattern match in the half curve
+            if idx is None:
+                idx = scores.argmin()
+            else:
+                first = clip(idx - separation, 0, len(scores) - 1)
+                idx = first + scores[first:idx + separation + 1].argmin()
+            return self._get_match_time(start_time, scores, idx)
+
+        candidates = []
+        for number, idx in enumerate(select_minima(full, count, separation)):
+            time = self._get_match_time(full_time, full, idx)
+            right_idx = None if not number else int(round((time - right_time) * self.sample_rate))
+            candidates.append(((full[idx], time),
+                               get_half_time(left_time, left, idx if number else None),
+                               get_half_time(right_time, right, right_idx)))
+        return candidates
+
+    def _get_split_scores(self, pattern, window_center, window_size):
+        """
+        Score curves of the pattern and its halves for find_substream_split as (time of the first score, scores).
+        The right half is searched around the center moved by the duration of the left one and its times
+        are moved back to be comparable with the rest.
+        """
+        half_size = len(pattern[0]) // 2
+        left, right = pattern[:, :half_size], pattern[:, half_size:]
+        right_offset = half_size / float(self.sample_rate)
+
+        full_range = self._get_search_range(pattern.shape[1], window_center, window_size)
+        left_range = self._get_search_range(left.shape[1], window_center, window_size)
+        right_range = self._get_search_range(right.shape[1], window_center + right_offset, window_size)
+        first_sample = min(full_range[1], left_range[1], right_range[1])
+        last_sample = max(full_range[2], left_range[2], right_range[2])
+
+        shared_pass = []
+
+        def get_shared_pass():
+            # done at most once and only if some of the scores aren't in the search cache
+            if not shared_pass:
+                search_source = self._get_samples(first_sample, last_sample)
+                shared_pass.extend((correlate(search_source, left, self.matcher),
+                                    correlate(search_source, right, self.matcher),
+                                    self._get_square_sums(search_source, first_sample)))
+            return shared_pass
+
+        def get_scores(search_range, pattern, cross_parts):
+            # cross_parts are (half index, offset) of half correlations summed into the correlation of the pattern
+            def compute(first, last):
+                left_cross, right_cross, squares = get_shared_pass()
+                half_crosses = left_cross, right_cross
+                pattern_size = pattern.shape[1]
+                start = first - first_sample
+                count = last - first + 1
+                cross = sum(half_crosses[half][start + offset:start + offset + count] for half, offset in cross_parts)
+                window_squares = squares[start + pattern_size:start + pattern_size + count] - squares[start:start + count]
+                return normalize_sqdiff(cross, window_squares, get_energy(pattern))[0]
+
+            start_time, start_sample, end_sample = search_range
+            return start_time, self._get_scores(pattern, start_sample, end_sample, compute)
+
+        right_time, right_scores = get_scores(right_range, right, [(1, 0)])
+        return (get_scores(full_range, pattern, [(0, 0), (1, half_size)]),
+                get_scores(left_range, left, [(0, 0)]),
+                (right_time - right_offset, right_scores))
+
+
+class BlockCache(object):
+    """
+    Bounded LRU cache of blocks of a stream, load(idx) gives blocks that aren't cached.
+    Blocks are loaded outside of the lock, so reading cached blocks never waits for a load,
+    and a block requested by several threads at once is still loaded only once.
+    """
+    def __init__(self, load, max_blocks):
+        self.max_blocks = max_blocks
+        self._load = load
+        # most recently used blocks are at the end
+        self._blocks = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._loaded = threading.Condition(self._lock)
+        self._loading = set()
+
+    def get(self, idx):
+        with self._lock:
+            while idx in self._loading:
+                self._loaded.wait()
+            block = self._blocks.pop(idx, None)
+            if block is not None:
+                self._blocks[idx] = block
+                return block
+            self._loading.add(idx)
+
+        block = None
+        try:
+            block = self._load(idx)
+        finally:
+            with self._lock:
+                # the block is stored before waiting threads wake up, so they don't load it again
+                if block is not None:
+                    self._blocks[idx] = block
+                    while len(self._blocks) > self.max_blocks:
+                        self._blocks.popitem(last=False)
+                self._loading.discard(idx)
+                self._loaded.notify_all()
+        return block
+
+    def __contains__(self, idx):
+        return idx in self._blocks
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def keys(self):
+        with self._lock:
+            return self._blocks.keys()
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+
+
+class LazyWavStream(WavStream):
+    """
+    WavStream that decodes and normalizes only the blocks of a WAV file that are actually requested.
+    Decoded blocks are kept in a bounded LRU cache and blocks passed to prefetch are decoded in a background thread.
+    Clipping values are estimated from a few evenly spaced segments instead of the whole file.
+    """
+    BLOCK_SECONDS = 30
+    ESTIMATE_SEGMENTS = 16
+    ESTIMATE_SECONDS = 5
+
+    def __init__(self, path, sample_rate=12000, sample_type='uint8', max_blocks=64):
+        if sample_type not in self.SAMPLE_TYPES:
+            raise SushiError('Unknown sample type of WAV stream, must be one of: {0}'
+                             .format(', '.join(self.SAMPLE_TYPES)))
+
+        self._reader = DownmixedWavFile(path)
+        self._path = path
+        self.sample_rate = sample_rate
+        self.sample_type = sample_type
+        self.padding_size = self.PADDING_SECONDS * sample_rate
+        self.sample_count = self._get_output_length(self._reader.frames_count, self._reader.framerate)
+        self.block_size = self.BLOCK_SECONDS * sample_rate
+        self._blocks = BlockCache(self._decode_block, max_blocks)
+        # blocks are decoded outside of the cache lock, but there's only one reader
+        self._reader_lock = threading.Lock()
+        self._prefetch_queue = Queue.Queue()
+        self._prefetch_thread = None
+
+        before_read = time()
+        try:
+            histogram = AmplitudeHistogram()
+            for segment in self._decode_estimate_segments():
+                histogram.add(segment)
+            self._min_value, self._max_value = histogram.get_clip_values()
+        except Exception as e:
+            self._reader.close()
+            raise SushiError('Error while loading {0}: {1}'.format(path, e))
+        logging.info('Opened WAV {0} for lazy reading in {1}s'.format(path, time() - before_read))
+
+    def _decode_estimate_segments(self):
+        segment_size = self.ESTIMATE_SECONDS * self.sample_rate
+        if self.sample_count <= segment_size * self.ESTIMATE_SEGMENTS:
+            yield self._decode_range(0, self.sample_count)
+            return
+        for start in np.linspace(0, self.sample_count - segment_size, self.ESTIMATE_SEGMENTS).astype(int):
+            yield self._decode_range(start, start + segment_size)
+
+    def _decode_range(self, start, end):
+        chunks = list(self._read_range(self._reader, start, end))
+        return np.concatenate(chunks) if chunks else np.empty(0, np.float32)
+
+    def _get_block(self, idx):
+        return self._blocks.get(idx)
+
+    def _decode_block(self, idx):
+        start = idx * self.block_size
+        end = min(start + self.block_size, self.sample_count)
+        with self._reader_lock:
+            decoded = self._decode_range(start, end)
+        return self._normalize(decoded, self._min_value, self._max_value, self.sample_type)
+
+    def _get_samples(self, start, end):
+        result = np.empty((1, end - start), self._get_dtype(self.sample_type))
+        # converting to positions inside of the actual audio
+        audio_start = start - self.padding_size
+        audio_end = end - self.padding_size
+
+        if audio_start < 0:
+            result[0, :min(-audio_start, len(result[0]))] = self._get_block(0)[0]
+        if audio_end > self.sample_count:
+            last_block = (self.sample_count - 1) // self.block_size
+            result[0, max(self.sample_count - audio_start, 0):] = self._get_block(last_block)[-1]
+
+        first = max(audio_start, 0)
+        last = min(audio_end, self.sample_count)
+        for idx in xrange(first // self.block_size, (last - 1) // self.block_size + 1 if last > first else 0):
+            block_start = idx * self.block_size
+            block = self._get_block(idx)
+            copy_start = max(first, block_start)
+            copy_end = min(last, block_start + len(block))
+            result[0, copy_start - audio_start:copy_end - audio_start] = block[copy_start - block_start:
+                                                                               copy_end - block_start]
+        return self._expand(result, self.sample_type)
+
+    def prefetch(self, start, end):
+        first = clip(int(start * self.sample_rate), 0, self.sample_count - 1) // self.block_size
+        last = clip(int(end * self.sample_rate), 0, self.sample_count - 1) // self.block_size
+        # never prefetch so much that blocks evict each other
+        last = min(last, first + self._blocks.max_blocks // 2 - 1)
+        missing = [idx for idx in xrange(first, last + 1) if idx not in self._blocks]
+        if not missing:
+            return
+        if not self._prefetch_thread:
+            self._prefetch_thread = threading.Thread(target=self._prefetch_worker)
+            self._prefetch_thread.daemon = True
+            self._prefetch_thread.start()
+        for idx in missing:
+            self._prefetch_queue.put(idx)
+
+    def _prefetch_worker(self):
+        while True:
+            idx = self._prefetch_queue.get()
+            if idx is None:
+                break
+            try:
+                self._get_block(idx)
+            except Exception as e:
+                logging.debug('Failed to prefetch block {0} of {1}: {2}'.format(idx, self._path, e))
+
+    def close(self):
+        if self._prefetch_thread:
+            self._prefetch_queue.put(None)
+            self._prefetch_thread.join()
+            self._prefetch_thread = None
+        with self._reader_lock:
+            self._reader.close()
+
+
+class OutOfCoreWavStream(WavStream):
+    """
+    WavStream that keeps its processed data in a temporary file once it doesn't fit into max_memory bytes.
+    The file is written through a memory map and later read through an LRU cache of blocks,
+    so only about max_memory bytes of the stream are ever held by the process.
+    Streams that fit into the budget are loaded into memory as usual.
+    """
+    BLOCK_SECONDS = 30
+    # memory taken by every decoding worker (its reader, resampler and histogram) with a lot of headroom
+    WORKER_MEMORY = 8 * 1024 * 1024
+
+    def __init__(self, path, sample_rate=12000, sample_type='uint8', max_memory=512 * 1024 * 1024, temp_dir=None,
+                 workers=None):
+        """
+        Unless given, the number of decoding workers is derived from max_memory
+        """
+        if workers is None:
+            workers = clip(max_memory // self.WORKER_MEMORY, 1, multiprocessing.cpu_count())
+        self.max_memory = max_memory
+        self._temp_dir = temp_dir
+        self._file = None
+        self._file_path = None
+        try:
+            super(OutOfCoreWavStream, self).__init__(path, sample_rate, sample_type, workers)
+            if self._file_path:
+                self._open_blocks()
+        except:
+            self.close()
+            raise
+
+    def _allocate(self):
+        dtype = self._get_dtype(self.sample_type)
+        shape = self._get_storage_shape()
+        if shape[1] * np.dtype(dtype).itemsize <= self.max_memory:
+            return super(OutOfCoreWavStream, self)._allocate()
+        handle, self._file_path = tempfile.mkstemp(suffix='.sushi.stream', dir=self._temp_dir)
+        os.close(handle)
+        # new files are filled with zeros, dirty pages of a file mapping can be written back and dropped by the system at any time
+        self.data = np.memmap(self._file_path, dtype=dtype, mode='w+', shape=shape)
+
+    def _open_blocks(self):
+        self.data.flush()
+        # read-only map only keeps the stream available as a whole (for WavStreamCache and such)
+        self.data = np.memmap(self._file_path, dtype=self.data.dtype, mode='r', shape=self.data.shape)
+        self._file = open(self._file_path, 'rb')
+        self.block_size = self.BLOCK_SECONDS * self.sample_rate
+        block_bytes = self.block_size * self.data.dtype.itemsize
+        self._blocks = BlockCache(self._read_block, max(self.max_memory // block_bytes, 2))
+        self._file_lock = threading.Lock()
+        logging.info('Keeping {0} bytes of processed audio on disk in {1}'.format(self.data.nbytes, self._file_path))
+
+    def _get_block(self, idx):
+        return self._blocks.get(idx)
+
+    def _read_block(self, idx):
+        with self._file_lock:
+            self._file.seek(idx * self.block_size * self.data.dtype.itemsize)
+            return np.fromfile(self._file, dtype=self.data.dtype, count=self.block_size)
+
+    def _get_stored(self, start, end):
+        if not self._file:
+            return super(OutOfCoreWavStream, self)._get_stored(start, end)
+        # padding is stored in the file too, so data is read exactly like from the in-memory array
+        start = clip(start, 0, self.data.shape[1])
+        end = clip(end, start, self.data.shape[1])
+        result = np.empty((1, end - start), self.data.dtype)
+        for idx in xrange(start // self.block_size, (end - 1) // self.block_size + 1 if end > start else 0):
+            block_start = idx * self.block_size
+            block = self._get_block(idx)
+            copy_start = max(start, block_start)
+            copy_end = min(end, block_start + len(block))
+            result[0, copy_start - start:copy_end - start] = block[copy_start - block_start:copy_end - block_start]
+        return result
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+        if self._file_path:
+            # the file can't be removed on windows while it's still mapped
+            self.data = None
+            try:
+                os.remove(self._file_path)
+            except OSError as e:
+                logging.debug('Failed to remove {0}: {1}'.format(self._file_path, e))
+            self._file_path = None
+
+
+class SparseWavStream(WavStream):
+    """
+    WavStream holding only some spans of the audio, like the parts of the source actually covered by a script.
+    Every span is read from its own reader (e.g. ffmpeg decoding from a seek point) and everything between
+    the spans is silence. Clipping values are computed from the spans only.
+    """
+    def __init__(self, spans, open_reader, duration, sample_rate=12000, sample_type='uint8', workers=None):
+        """
+        spans is a sorted list of non-overlapping (start, end) times, open_reader(start, end) returns a reader
+        for every one of them. Readers are read to the end and closed.
+        """
+        if sample_type not in self.SAMPLE_TYPES:
+            raise SushiError('Unknown sample type of WAV stream, must be one of: {0}'
+                             .format(', '.join(self.SAMPLE_TYPES)))
+        self.sample_rate = sample_rate
+        self.sample_type = sample_type
+        self.padding_size = self.PADDING_SECONDS * sample_rate
+        self.sample_count = int(round(duration * sample_rate))
+
+        before_read = time()
+        try:
+            # every reader is usually a separate process, but there's no point running more of them than cores
+            pool = ThreadPool(clip(workers or multiprocessing.cpu_count(), 1, max(len(spans), 1)))
+            try:
+                decoded = pool.map(lambda span: self._decode_span(open_reader, *span), spans)
+            finally:
+                pool.close()
+                pool.join()
+
+            histogram = AmplitudeHistogram()
+            for _, _, span_histogram in decoded:
+                histogram.update(span_histogram)
+            min_value, max_value = histogram.get_clip_values()
+
+            self._silence = self._normalize(np.zeros(1, np.float32), min_value, max_value, sample_type)[0]
+            self._segments = []
+            for start, samples, _ in self._drain(decoded):
+                normalized = self._normalize(samples.astype(np.float32), min_value, max_value, sample_type)
+                self._segments.append((self.padding_size + start, normalized))
+            self._segment_starts = [start for start, _ in self._segments]
+        except Exception as e:
+            raise SushiError('Error while loading audio spans: {0}'.format(e))
+        logging.info('Done reading {0} spans ({1:.1f}s of audio) in {2}s'
+                     .format(len(spans), sum(end - start for start, end in spans), time() - before_read))
+
+    def _decode_span(self, open_reader, start, end):
+        reader = open_reader(start, end)
+        histogram = AmplitudeHistogram()
+        chunks = []
+        try:
+            for chunk in self._read_chunks(reader):
+                histogram.add(chunk)
+                chunks.append(np.clip(np.rint(chunk), -32768, 32767).astype(np.int16))
+        finally:
+            reader.close()
+        samples = np.concatenate(chunks) if chunks else np.empty(0, np.int16)
+        return int(round(start * self.sample_rate)), samples, histogram
+
+    def _get_samples(self, start, end):
+        result = np.empty((1, end - start), self._get_dtype(self.sample_type))
+        result.fill(self._silence)
+        idx = max(bisect.bisect_right(self._segment_starts, start) - 1, 0)
+        for segment_start, samples in self._segments[idx:]:
+            if segment_start >= end:
+                break
+            copy_start = max(start, segment_start)
+            copy_end = min(end, segment_start + len(samples))
+            if copy_start < copy_end:
+                result[0, copy_start - start:copy_end - start] = samples[copy_start - segment_start:
+                                                                         copy_end - segment_start]
+        return self._expand(result, self.sample_type)
+
+
+class SharedWavStream(WavStream):
+    """
+    WavStream whose data lives in a file in shared memory (/dev/shm when available), so any number of processes
+    can attach to it by name and use one physical copy of the data. Data that is already memory-mapped from a file
+    is attached to right where it is. The energy index and the pyramid are shared
+    the same way if the stream has them.
+    Pickling only passes the name, so shared streams can be given to multiprocessing workers for free.
+    Only the stream returned by publish removes the data when closed.
+    """
+    SHARED_DIRECTORY = '/dev/shm'
+
+    @classmethod
+    def publish(cls, stream, directory=None):
+        if not hasattr(stream, 'data'):
+            raise SushiError("Stream {0} doesn't keep its data and can't be shared".format(stream))
+        if directory is None:
+            directory = cls.SHARED_DIRECTORY if os.path.isdir(cls.SHARED_DIRECTORY) else tempfile.gettempdir()
+        created = []
+        try:
+            handle, name = tempfile.mkstemp(prefix='sushi-', suffix='.json', dir=directory)
+            os.close(handle)
+            created.append(name)
+            info = {'sample_rate': stream.sample_rate, 'sample_count': stream.sample_count,
+                    'sample_type': stream.sample_type, 'created': created,
+                    'data': cls._get_backing_file(stream.data) or cls._save_array(stream.data, directory, created),
+                    'energy': cls._save_array(stream.energy, directory, created) if stream.energy is not None
+                    else None,
+                    'pyramid': [(factor, cls._save_array(level, directory, created))
+                                for factor, level in stream.pyramid or []]}
+            with open(name, 'w') as info_file:
+                json.dump(info, info_file)
+        except (IOError, OSError) as e:
+            # e.g. a full /dev/shm
+            cls._remove(created)
+            raise SushiError("Couldn't share stream in {0}: {1}".format(directory, e))
+        except:
+            cls._remove(created)
+            raise
+        return cls.attach(name, owner=True)
+
+    @staticmethod
+    def _get_backing_file(array):
+        """
+        Description of the file a memory-mapped array (like the data of OutOfCoreWavStream or of a stream loaded
+        from WavStreamCache) comes from, so it can be attached to without copying. None for other arrays.
+        """
+        if not isinstance(array, np.memmap) or not isinstance(array.base, mmap.mmap) or not array.filename:
+            return None
+        return {'path': array.filename, 'dtype': array.dtype.str, 'shape': array.shape, 'offset': array.offset}
+
+    @staticmethod
+    def _save_array(array, directory, created):
+        # arrays are written as raw data and mapped back by their description
+        handle, path = tempfile.mkstemp(prefix='sushi-', suffix='.bin', dir=directory)
+        created.append(path)
+        with os.fdopen(handle, 'wb') as array_file:
+            np.ascontiguousarray(array).tofile(array_file)
+        return {'path': path, 'dtype': array.dtype.str, 'shape': array.shape, 'offset': 0}
+
+    @staticmethod
+    def _load_array(description):
+        return np.memmap(description['path'], dtype=np.dtype(str(description['dtype'])), mode='r',
+                         shape=tuple(description['shape']), offset=description['offset'])
+
+    @classmethod
+    def attach(cls, name, owner=False):
+        try:
+            with open(name) as info_file:
+                info = json.load(info_file)
+            data = cls._load_array(info['data'])
+            energy = cls._load_array(info['energy']) if info['energy'] else None
+            pyramid = [(factor, cls._load_array(level)) for factor, level in info['pyramid']]
+        except (IOError, OSError, ValueError, KeyError) as e:
+            raise SushiError("Couldn't attach to shared stream {0}: {1}".format(name, e))
+        stream = cls.from_array(data, info['sample_rate'], info['sample_count'], info['sample_type'])
+        if energy is not None:
+            stream.energy = energy
+        if pyramid:
+            stream.pyramid = pyramid
+        stream.name = name
+        stream._created = info['created'] if owner else []
+        return stream
+
+    @staticmethod
+    def _remove(paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logging.debug('Failed to remove {0}: {1}'.format(path, e))
+
+    def __getstate__(self):
+        return {'name': self.name}
+
+    def __setstate__(self, state):
+        self.__dict__.update(self.attach(state['name']).__dict__)
+
+    def close(self):
+        if self._created:
+            # the files can't be removed on windows while they're still mapped
+            self.data = None
+            self.energy = None
+            self.pyramid = None
+            self._remove(self._created)
+            self._created = []
+
+
+class WavStreamCache(object):
+    """
+    Persistent cache of normalized WavStream data.
+    Every entry is stored as a .npy file (so it can be memory-mapped when loaded) plus a small .json file with
+    the stream parameters. Modification time of the .npy file is used to evict least recently used entries
+    once the total size of the cache goes over max_size bytes.
+    """
+    def __init__(self, directory, max_size):
+        super(WavStreamCache, self).__init__()
+        self.directory = directory
+        self.max_size = max_size
+        # streams can be stored from several loader threads at once
+        self._lock = threading.Lock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def make_key(path, sample_rate, sample_type, audio_stream=None):
+        stat = os.stat(path)
+        identity = [os.path.abspath(path), stat.st_size, int(stat.st_mtime), audio_stream, sample_rate, sample_type]
+        return hashlib.sha1(json.dumps(identity)).hexdigest()
+
+    def _get_paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + '.npy', base + '.json'
+
+    def load(self, key):
+        data_path, info_path = self._get_paths(key)
+        try:
+            with open(info_path) as info_file:
+                info = json.load(info_file)
+            data = np.load(data_path, mmap_mode='r')
+            os.utime(data_path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        logging.info('Loaded cached stream {0}'.format(data_path))
+        return WavStream.from_array(data, info['sample_rate'], info['sample_count'], info['sample_type'])
+
+    def store(self, key, stream):
+        """
+        Failures are only logged, since other processes can be storing the same entry at the same time
+        """
+        if stream.data.nbytes > self.max_size:
+            logging.info("Stream is too large to be cached ({0} bytes)".format(stream.data.nbytes))
+            return
+        with self._lock:
+            self._evict(self.max_size - stream.data.nbytes)
+
+            data_path, info_path = self._get_paths(key)
+            # the info file goes first, load ignores it until the data file is in place too
+            try:
+                self._write(info_path, lambda info_file: json.dump(
+                    {'sample_rate': stream.sample_rate, 'sample_count': stream.sample_count,
+                     'sample_type': stream.sample_type}, info_file))
+                self._write(data_path, lambda data_file: np.save(data_file, stream.data))
+            except (IOError, OSError) as e:
+                logging.warning("Couldn't store stream {0} in the cache: {1}".format(data_path, e))
+
+    def _write(self, path, write):
+        # every writer uses its own temporary file so other processes never see incomplete entries
+        handle, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(handle, 'wb') as temp_file:
+                write(temp_file)
+            self._replace(temp_path, path)
+        except:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+    def _evict(self, allowed_size):
+        entries = []
+        for path in glob.glob(os.path.join(self.directory, '*.npy')):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+
+        total_size = sum(e[1] for e in entries)
+        for _, size, path in entries:
+            if total_size <= allowed_size:
+                break
+            logging.info('Evicting cached stream {0}'.format(path))
+            for entry_path in (path, os.path.splitext(path)[0] + '.json'):
+                try:
+                    os.remove(entry_path)
+                except OSError:
+                    pass
+            total_size -= size
+
+    @staticmethod
+    def _replace(source, destination):
+        try:
+            os.rename(source, destination)
+        except OSError:
+            # os.rename doesn't overwrite existing files on windows
+            if not os.path.exists(destination):
+                raise
+            os.remove(destination)
+            os.rename(source, destination)